@@ -0,0 +1,512 @@
+#!/usr/bin/python
+""" Benchmark for Ticket Supervisor, "Paavo"
+    that
+    - starts a local stand-in for the ServiceNow Table API (GET with encoded query & paging, PATCH/PUT)
+    - creates synthetic tickets and rule files (N tickets x M rules, mix of "", ~, =, @ and * finds)
+    - runs TicketSupervisor against it with --once and/or as a daemon loop
+    - reports tickets/sec, round wall time as fetch/match/act, API calls and peak RSS
+    - saves the results (bench-results.jsonl), compared to the previous run with the same parameters
+
+* Prerequisites
+    python (preferably v3), with the prerequisites of TicketSupervisor
+
+* Use: BenchTicketSupervisor [--tickets 2000] [--rules 50] [--mix "in:4,re:2,eq:1,btw:1,ref:1"]
+         [--latency_ms 20] [--error_rate 0.0] [--robots 1] [--mode once|daemon|both] [--daemon_sec 30]
+         [--set key=value ...] [--label text] [--out bench-results.jsonl] [--ts TicketSupervisor.py]
+         [--webhook_rate 5 [--burst 3]]
+
+  --set goes to the global section of the generated TicketSupervisor.cfg, e.g. --set pushdown=True
+  --ts lets you run another version of TicketSupervisor.py with the same tickets and rules
+  --webhook_rate turns the webhook of the daemon on and sends it notifications of tickets updated meanwhile
+
+"""
+############################################################################################
+import yaml, argparse, sys, os, datetime, re, json, random, time, threading, tempfile, shutil, subprocess, atexit, signal, runpy, socket
+import urllib.request
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+VERSION="0.1.0"
+mpfx="BEN"                                           # Message prefix
+rss_file="bench-rss.json"                            # Peak RSS of TicketSupervisor, written by --child
+words=["printer","vpn","password","laptop","email","outlook","network","disk","backup","license","teams","access",
+       "reset","slow","crash","error","install","update","monitor","keyboard","phone","badge","server","share",
+       "citrix","sap","oracle","wifi","mouse","headset","camera","excel","word","onedrive","sharepoint","jira",
+       "firewall","proxy","certificate","token","mailbox","calendar","meeting","dock","battery","screen","driver","font"]
+regex_round=re.compile(r'Round done in ([\d.]+) s: tickets=(\d+) matched=(\d+) fetch=([\d.]+) match=([\d.]+) act=([\d.]+)')
+regex_cond=re.compile(r'^([a-z0-9_.]+)(ISNOTEMPTY|ISEMPTY|NOT IN|NOT LIKE|NOTLIKE|IN|LIKE|STARTSWITH|ENDSWITH|BETWEEN|!=|>=|<=|=|>|<)(.*)$')
+regex_datejs=re.compile(r'javascript:gs\.dateGenerate\("([^"]*)"\)')
+regex_ids=re.compile(r'sys_idIN([0-9a-f,]+)')
+############################################################################################
+def prtmsg(txt,mid="000",msuf="I"):
+    '''Print a message to the console. Include a message prefix and timestamp'''
+    logstr="{}{}{} {} {}".format(mpfx,mid,msuf,datetime.datetime.now().strftime('%d-%H%M%S'),txt)
+    print(logstr)
+
+def Norm(val):
+    '''Compare values the way SNC does: case insensitive, booleans as 1/0'''
+    val="{}".format(val).lower()
+    return {"true": "1", "false": "0"}.get(val,val)
+
+def ParseCondition(cond):
+    '''"fieldOPERvalue" of an encoded query into (field, operator, value)'''
+    match=regex_cond.match(cond)
+    if match is None:
+        raise ValueError("Invalid condition: {}".format(cond))
+    fld,oper,arg=match.groups()
+    arg=regex_datejs.sub(r'\1',arg.replace("\x00","^"))
+    if oper=="BETWEEN":
+        arg=tuple(arg.split("@",1))
+    elif oper in ("IN","NOT IN"):
+        arg=frozenset(Norm(val) for val in arg.split(","))
+    return (fld,oper,arg)
+
+@lru_cache(maxsize=256)
+def ParseQuery(query):
+    '''Encoded query into (branches, order). A branch (^NQ) is a list of AND groups, a group a list of OR conditions.'''
+    branches=[]
+    order=[]
+    for part in query.replace("^^","\x00").split("^NQ"):
+        groups=[]
+        for cond in part.split("^"):
+            if not cond:
+                continue
+            if cond.startswith("ORDERBYDESC"):
+                order.append((cond[11:],True))
+            elif cond.startswith("ORDERBY"):
+                order.append((cond[7:],False))
+            elif cond.startswith("OR") and groups:    # ^OR binds to the condition before it
+                groups[-1].append(ParseCondition(cond[2:]))
+            else:
+                groups.append([ParseCondition(cond)])
+        branches.append(groups)
+    return branches,order
+
+def TestCondition(tkt,fld,oper,arg):
+    val="{}".format(tkt.get(fld,""))
+    if oper=="=":
+        return Norm(val)==Norm(arg)
+    if oper=="!=":
+        return Norm(val)!=Norm(arg)
+    if oper=="IN":
+        return Norm(val) in arg
+    if oper=="NOT IN":
+        return Norm(val) not in arg
+    if oper=="LIKE":
+        return arg.lower() in val.lower()
+    if oper in ("NOT LIKE","NOTLIKE"):
+        return arg.lower() not in val.lower()
+    if oper=="ISEMPTY":
+        return val==""
+    if oper=="ISNOTEMPTY":
+        return val!=""
+    if oper=="STARTSWITH":
+        return val.lower().startswith(arg.lower())
+    if oper=="ENDSWITH":
+        return val.lower().endswith(arg.lower())
+    if oper=="BETWEEN":
+        return arg[0]<=val<=arg[1]
+    if val.isdigit() and arg.isdigit():
+        val,arg=int(val),int(arg)
+    return {">": val>arg, "<": val<arg, ">=": val>=arg, "<=": val<=arg}[oper]
+
+def TicketMatches(tkt,branches):
+    return any(all(any(TestCondition(tkt,*cond) for cond in group) for group in groups) for groups in branches)
+
+class FakeSnc(ThreadingHTTPServer):
+    '''Stand-in for the Table API of ServiceNow: /api/now/table/[table](/[sys_id])'''
+    daemon_threads=True
+
+    def __init__(self,tables,latency=0.0,error_rate=0.0):
+        ThreadingHTTPServer.__init__(self,("127.0.0.1",0),SncHandler)
+        self.original=tables                          # table -> list of tickets
+        self.latency=latency
+        self.error_rate=error_rate
+        self.lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Tickets as created, zero counters'''
+        with self.lock:
+            self.tables={table: {tkt['sys_id']: dict(tkt) for tkt in tkts} for table,tkts in self.original.items()}
+            self.generation=0                         # Changed on every update, results cached until then
+            self.results={}
+            self.counts=Counter()
+            self.notified={}                          # sys_id -> time.monotonic() of the webhook notification
+            self.latencies=[]                         # From notification to the ticket read by the supervisor
+
+    def select(self,table,query):
+        '''Tickets of table matching the encoded query, in its order'''
+        with self.lock:
+            key=(table,query,self.generation)
+            if key not in self.results:
+                branches,order=ParseQuery(query)
+                tkts=[tkt for tkt in self.tables.get(table,{}).values() if TicketMatches(tkt,branches)]
+                for fld,desc in reversed(order):
+                    tkts.sort(key=lambda tkt: "{}".format(tkt.get(fld,"")),reverse=desc)
+                self.results={key: tkts}              # The latest query only, paged through
+            return self.results[key]
+
+    def fetched(self,query):
+        '''Note the tickets notified and now read by sys_id'''
+        match=regex_ids.search(query)
+        if match:
+            now=time.monotonic()
+            with self.lock:
+                for sys_id in match.group(1).split(","):
+                    if sys_id in self.notified:
+                        self.latencies.append(now-self.notified.pop(sys_id))
+
+    def update(self,table,sys_id,dta):
+        with self.lock:
+            tkt=self.tables.get(table,{}).get(sys_id)
+            if tkt is None:
+                return None
+            tkt.update({key: "{}".format(val) for key,val in dta.items()})
+            tkt['sys_updated_on']=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.generation+=1
+            return dict(tkt)
+
+class SncHandler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"                       # Keep-alive, like SNC
+
+    def log_message(self,*args):
+        pass
+
+    def reply(self,code,dta):
+        body=json.dumps(dta).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        '''(table, sys_id, query string) of the request, or None after an injected error'''
+        srv=self.server
+        srv.counts[self.command]+=1
+        if srv.latency:
+            time.sleep(srv.latency)
+        if srv.error_rate and random.random()<srv.error_rate:
+            srv.counts['errors']+=1
+            code=random.choice([429,503])
+            self.reply(code,{"error": {"message": "Injected error {}".format(code)}, "status": "failure"})
+            return None
+        url=urlsplit(self.path)
+        parts=url.path.strip("/").split("/")         # api now table [table] ([sys_id])
+        if parts[0:3]!=["api","now","table"] or len(parts) not in (4,5):
+            self.reply(400,{"error": {"message": "Invalid path {}".format(url.path)}, "status": "failure"})
+            return None
+        return parts[3],parts[4] if len(parts)==5 else None,parse_qs(url.query)
+
+    def do_GET(self):
+        req=self.route()
+        if req is None:
+            return
+        table,sys_id,qs=req
+        query=qs.get('sysparm_query',[""])[0]
+        if sys_id:
+            query="sys_id={}".format(sys_id)
+        self.server.fetched(query)
+        try:
+            tkts=self.server.select(table,query)
+        except ValueError as e:
+            self.reply(400,{"error": {"message": str(e)}, "status": "failure"})
+            return
+        offset=int(qs.get('sysparm_offset',["0"])[0] or 0)
+        limit=int(qs.get('sysparm_limit',["10000"])[0] or 10000)
+        fields=[fld for fld in qs.get('sysparm_fields',[""])[0].split(",") if fld]
+        page=tkts[offset:offset+limit]
+        if fields:
+            page=[{fld: tkt.get(fld,"") for fld in fields} for tkt in page]
+        self.server.counts['tickets']+=len(page)
+        self.reply(200,{"result": page})
+
+    def do_PATCH(self):
+        body=self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        req=self.route()
+        if req is None:
+            return
+        table,sys_id,qs=req
+        dta=json.loads(body or b"{}")
+        tkt=self.server.update(table,sys_id,dta)
+        if tkt is None:
+            self.reply(404,{"error": {"message": "No Record found"}, "status": "failure"})
+        else:
+            self.reply(200,{"result": tkt})
+
+    do_PUT=do_PATCH
+############################################################################################
+def MakeTickets(count,rnd,table="incident"):
+    '''Synthetic tickets with the usual fields'''
+    now=datetime.datetime.now()
+    tkts=[]
+    for ix in range(count):
+        created=now-datetime.timedelta(seconds=rnd.randint(0,7*24*3600))
+        caller="user{}".format(rnd.randint(1,200))
+        tkts.append({
+            'number': "INC{:07d}".format(ix+1),
+            'sys_id': "{:032x}".format(rnd.getrandbits(128)),
+            'active': "true",
+            'state': rnd.choice(["1","1","1","2","2","3","6"]),
+            'priority': "{}".format(rnd.randint(1,5)),
+            'category': rnd.choice(["software","hardware","network","inquiry"]),
+            'assignment_group': rnd.choice(["","grp1","grp2","grp3"]),
+            'assigned_to': rnd.choice(["","","agent1","agent2"]),
+            'caller_id': caller,
+            'opened_by': rnd.choice([caller,"user{}".format(rnd.randint(1,200))]),
+            'short_description': " ".join(rnd.sample(words,rnd.randint(3,6))),
+            'description': " ".join(rnd.choice(words) for _ in range(rnd.randint(10,40))),
+            'sys_created_on': created.strftime("%Y-%m-%d %H:%M:%S"),
+            'sys_updated_on': (created+datetime.timedelta(seconds=rnd.randint(0,3600))).strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return tkts
+
+def MakeFind(kind,rnd):
+    '''A find entry of the given kind'''
+    if kind=="in":
+        return {rnd.choice(["short_description","description"]): "{}{}".format("^" if rnd.random()<0.2 else "",rnd.choice(words))}
+    if kind=="re":
+        return {rnd.choice(["short_description","description"]): "~{}|{}".format(*rnd.sample(words,2))}
+    if kind=="eq":
+        return rnd.choice([{'priority': "={}".format(rnd.randint(1,5))},{'assigned_to': "="},{'state': "={}".format(rnd.choice(["1","2"]))}])
+    if kind=="btw":
+        return {'sys_created_on': "{}@now - {}h".format(rnd.choice(["","^"]),rnd.randint(1,96))}
+    if kind=="ref":
+        return {'caller_id': "*opened_by"}
+    raise ValueError("Unknown find kind: {}".format(kind))
+
+def MakeRules(count,mix,act_ratio,rnd):
+    '''Synthetic rules, each with 2-4 finds picked by the weights of mix'''
+    kinds=list(mix.keys())
+    weights=list(mix.values())
+    rules=[]
+    for ix in range(count):
+        find=[MakeFind(kind,rnd) for kind in rnd.choices(kinds,weights,k=rnd.randint(2,4))]
+        act=[{'update': {'comments': "Bench rule {} on {{number}}".format(ix+1)}}] if rnd.random()<act_ratio else ["nop"]
+        rules.append({'name': "Bench{:03d}".format(ix+1), 'find': find, 'act': act})
+    return rules
+
+def ParseMix(txt):
+    mix={}
+    for item in txt.split(","):
+        kind,weight=item.split(":")
+        mix[kind.strip()]=float(weight)
+    return mix
+
+def ParseSet(items):
+    '''key=value pairs of --set, values as in YAML'''
+    cfg={}
+    for item in items or []:
+        key,val=item.split("=",1)
+        cfg[key]=yaml.safe_load(val)
+    return cfg
+############################################################################################
+def RunChild(tspath,args):
+    '''Run TicketSupervisor in this process (--child), write its peak RSS to rss_file at exit'''
+    def SaveRss():
+        try:
+            import resource
+            rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform=="darwin":                # bytes there, KB elsewhere
+                rss//=1024
+        except ImportError:                           # Not on windows
+            rss=None
+        with open(rss_file,'w') as rf:
+            json.dump({'rss_kb': rss},rf)
+    atexit.register(SaveRss)
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    sys.argv=[tspath]+args
+    runpy.run_path(tspath,run_name="__main__")
+
+def SendNotifications(srv,port,rate,burst,stop):
+    '''Stand-in for the business rule of SNC: update random tickets and notify the webhook of each of them
+       burst times, rate tickets per second, until stop is set'''
+    rnd=random.Random(2)
+    while not stop.wait(1.0/rate):
+        with srv.lock:
+            tkt=rnd.choice(list(srv.tables["incident"].values()))
+        srv.update("incident",tkt['sys_id'],{'description': "{} {}".format(tkt['description'],rnd.choice(words))})
+        with srv.lock:
+            srv.notified.setdefault(tkt['sys_id'],time.monotonic())
+        evt=json.dumps({'table': "incident", 'sys_id': tkt['sys_id'], 'number': tkt['number']}).encode('utf-8')
+        for _ in range(burst):
+            try:
+                urllib.request.urlopen(urllib.request.Request("http://127.0.0.1:{}/".format(port),data=evt,
+                    headers={'Content-Type': "application/json"}),timeout=5).read()
+                srv.counts['notified']+=1
+            except OSError:                           # Not listening yet
+                srv.counts['notify_errors']+=1
+
+def FreePort():
+    with socket.socket() as sck:
+        sck.bind(("127.0.0.1",0))
+        return sck.getsockname()[1]
+
+def RunSupervisor(tspath,work_dir,args,srv,duration=None,webhook=None):
+    '''Run TicketSupervisor once or for duration seconds, return its measures.
+       With webhook (port, rate, burst), notifications are sent to it meanwhile.'''
+    srv.reset()
+    for filen in os.listdir(work_dir):                # Logs of the previous run
+        if filen.startswith("actions-") or filen.startswith("z_state_") or filen==rss_file:
+            os.remove(os.path.join(work_dir,filen))
+    started=time.monotonic()
+    child=subprocess.Popen([sys.executable,os.path.abspath(__file__),"--child",tspath]+args,cwd=work_dir,
+        stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+    stop=threading.Event()
+    if webhook:
+        threading.Thread(target=SendNotifications,args=(srv,)+tuple(webhook)+(stop,),name="notify",daemon=True).start()
+    try:
+        (_,err)=child.communicate(timeout=duration)
+    except subprocess.TimeoutExpired:
+        stop.set()
+        child.terminate()
+        (_,err)=child.communicate()
+    stop.set()
+    wall=time.monotonic()-started
+    if err:
+        prtmsg("TicketSupervisor stderr: {}".format(err.decode('utf-8','replace').strip()[-500:]),"190","W")
+    rounds=[]
+    errors=Counter()
+    for filen in sorted(os.listdir(work_dir)):
+        if filen.startswith("actions-") and filen.endswith(".log"):
+            with open(os.path.join(work_dir,filen),'r',errors='replace') as logf:
+                for line in logf:
+                    match=regex_round.search(line)
+                    if match:
+                        rounds.append([float(val) for val in match.groups()])
+                    elif line[6:7]=="E":              # PVE191E etc.
+                        errors[line[0:7]]+=1
+    rss=None
+    if os.path.isfile(os.path.join(work_dir,rss_file)):
+        with open(os.path.join(work_dir,rss_file),'r') as rf:
+            rss=json.load(rf).get('rss_kb')
+    tot=[sum(col) for col in zip(*rounds)] or [0.0]*6
+    lat=sorted(srv.latencies)
+    return {
+        'webhook': {'read': len(lat), 'not_read': len(srv.notified),
+            'p50_ms': round(lat[len(lat)//2]*1000,1) if lat else None,
+            'p95_ms': round(lat[int(len(lat)*0.95)]*1000,1) if lat else None} if webhook else None,
+        'wall': round(wall,3),
+        'rounds': len(rounds),
+        'tickets': int(tot[1]),
+        'matched': int(tot[2]),
+        'round_wall': round(tot[0],3),
+        'tickets_per_sec': round(tot[1]/tot[0],1) if tot[0] else None,
+        'fetch': round(tot[3],3),
+        'match': round(tot[4],3),
+        'act': round(tot[5],3),
+        'api': dict(srv.counts),
+        'log_errors': dict(errors),
+        'rss_kb': rss,
+    }
+
+def ShowResult(mode,res,prev):
+    prtmsg("{}: {} rounds, {} tickets ({} matched) in {} s, {} tickets/s; fetch {} s, match {} s, act {} s".format(mode,
+        res['rounds'],res['tickets'],res['matched'],res['round_wall'],res['tickets_per_sec'],res['fetch'],res['match'],res['act']),"100")
+    prtmsg("{}: API {}, peak RSS {} MB, errors logged {}, process wall {} s".format(mode,
+        " ".join("{}={}".format(key,val) for key,val in sorted(res['api'].items())),
+        round(res['rss_kb']/1024,1) if res['rss_kb'] else "n/a",res['log_errors'] or "none",res['wall']),"101")
+    if res.get('webhook'):
+        prtmsg("{}: webhook, notified tickets read after p50 {} ms, p95 {} ms; {} read, {} not".format(mode,
+            res['webhook']['p50_ms'],res['webhook']['p95_ms'],res['webhook']['read'],res['webhook']['not_read']),"103")
+    if prev and prev.get('tickets_per_sec') and res['tickets_per_sec']:
+        prtmsg("{}: {} tickets/s before ({}), now {}, {:+.1f} %".format(mode,prev['tickets_per_sec'],prev.get('label') or prev.get('ts',''),
+            res['tickets_per_sec'],(res['tickets_per_sec']/prev['tickets_per_sec']-1)*100),"102")
+
+def PreviousResult(out,params,mode):
+    '''The latest result saved with the same parameters'''
+    prev=None
+    if os.path.isfile(out):
+        with open(out,'r') as of:
+            for line in of:
+                try:
+                    res=json.loads(line)
+                except ValueError:
+                    continue
+                if res.get('params')==params and res.get('mode')==mode:
+                    prev=res
+    return prev
+
+def BenchTicketSupervisor(runa):
+    '''Create tickets and rules, start the fake SNC, run the supervisor and report'''
+    rnd=random.Random(runa.seed)
+    robots=["Bench{}".format(ix+1) for ix in range(runa.robots)]
+    tables={"incident": MakeTickets(runa.tickets,rnd)}
+    rules={rbt: MakeRules(runa.rules,ParseMix(runa.mix),runa.act_ratio,rnd) for rbt in robots}
+    srv=FakeSnc(tables,runa.latency_ms/1000.0,runa.error_rate)
+    threading.Thread(target=srv.serve_forever,name="FakeSnc",daemon=True).start()
+    work_dir=runa.work_dir or tempfile.mkdtemp(prefix="BenchTicketSupervisor-")
+    gcfg={
+        'snc': "bench", 'snc_host': "127.0.0.1:{}".format(srv.server_address[1]), 'use_ssl': False,
+        'user': "bench", 'pwd': "bench", 'appname': robots, 'cfg_dir': ".", 'log_dir': ".",
+        'sleep_sec_between': runa.sleep, 'round_stats': True, 'max_retry_connect': 0,
+        'first_match_only': True, 'update_rate': 200,  # Measure us, not the API quota
+    }
+    if runa.webhook_rate:
+        gcfg.update(webhook_port=FreePort(),webhook_reconcile_sec=600)
+    gcfg.update(ParseSet(runa.set))
+    whole={'global': gcfg}
+    for rbt in robots:
+        whole[rbt]={'msg_prefix': "B{:02d}".format(robots.index(rbt)+1)}
+        with open(os.path.join(work_dir,"{}.txt".format(rbt)),'w') as rf:
+            json.dump(rules[rbt],rf,indent=1)         # JSON is YAML as well
+    with open(os.path.join(work_dir,"TicketSupervisor.cfg"),'w') as cf:
+        json.dump(whole,cf,indent=1)
+    tspath=os.path.abspath(runa.ts)
+    params={'tickets': runa.tickets, 'rules': runa.rules, 'mix': runa.mix, 'act_ratio': runa.act_ratio, 'robots': runa.robots,
+        'latency_ms': runa.latency_ms, 'error_rate': runa.error_rate, 'seed': runa.seed, 'set': ParseSet(runa.set),
+        'simulate': runa.simulate, 'daemon_sec': runa.daemon_sec, 'sleep': runa.sleep, 'webhook_rate': runa.webhook_rate, 'burst': runa.burst}
+    prtmsg("{} tickets, {} rules x {} robots ({}), work dir {}".format(runa.tickets,runa.rules,runa.robots,runa.mix,work_dir),"001")
+    extra=["--quiet"]+(["--simulate"] if runa.simulate else [])
+    try:
+        for mode in (["once","daemon"] if runa.mode=="both" else [runa.mode]):
+            if mode=="once":
+                res=RunSupervisor(tspath,work_dir,["--once"]+extra,srv)
+            else:
+                webhook=(gcfg['webhook_port'],runa.webhook_rate,runa.burst) if runa.webhook_rate else None
+                res=RunSupervisor(tspath,work_dir,extra,srv,runa.daemon_sec,webhook)
+            res.update(ts=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),label=runa.label,mode=mode,params=params,
+                supervisor=tspath)
+            ShowResult(mode,res,PreviousResult(runa.out,params,mode))
+            with open(runa.out,'a') as of:            # Saved for comparison
+                of.write("{}\n".format(json.dumps(res)))
+    finally:
+        srv.shutdown()
+        if not runa.work_dir and not runa.keep:
+            shutil.rmtree(work_dir,ignore_errors=True)
+############################################################################################
+if __name__ == '__main__':
+    if sys.argv[1:2]==["--child"]:                    # TicketSupervisor run by RunSupervisor
+        RunChild(sys.argv[2],sys.argv[3:])
+        sys.exit()
+    try:
+        me=os.path.basename(sys.argv[0])
+        if "--version" in sys.argv:
+            prtmsg("Version: {} - {}".format(VERSION,me))
+            sys.exit()
+        parser=argparse.ArgumentParser(description='Benchmark for Personal Assistant for ServiceNow Tickets, against a local fake ServiceNow.')
+        parser.add_argument("--tickets", help="Number of tickets", action="store", dest="tickets", default=2000, type=int)
+        parser.add_argument("--rules", help="Number of rules per robot", action="store", dest="rules", default=50, type=int)
+        parser.add_argument("--mix", help="Weights of find kinds: in (contains), re (~), eq (=), btw (@), ref (*)", action="store", dest="mix", default="in:4,re:2,eq:1,btw:1,ref:1")
+        parser.add_argument("--act_ratio", help="Share of rules updating the ticket, others nop", action="store", dest="act_ratio", default=0.2, type=float)
+        parser.add_argument("--robots", help="Number of robots, each with rules of its own", action="store", dest="robots", default=1, type=int)
+        parser.add_argument("--latency_ms", help="Delay of each API call", action="store", dest="latency_ms", default=20.0, type=float)
+        parser.add_argument("--error_rate", help="Share of API calls answered with 429/503", action="store", dest="error_rate", default=0.0, type=float)
+        parser.add_argument("--mode", help="Run --once, as daemon or both", action="store", dest="mode", default="both", choices=["once","daemon","both"])
+        parser.add_argument("--daemon_sec", help="How long to run the daemon", action="store", dest="daemon_sec", default=30.0, type=float)
+        parser.add_argument("--sleep", help="sleep_sec_between of the daemon", action="store", dest="sleep", default=1, type=int)
+        parser.add_argument("--webhook_rate", help="On daemon, notify the webhook of this many updated tickets per second", action="store", dest="webhook_rate", default=0.0, type=float)
+        parser.add_argument("--burst", help="Notifications sent of each updated ticket", action="store", dest="burst", default=3, type=int)
+        parser.add_argument("--simulate", help="Run TicketSupervisor with --simulate", action="store_true", dest="simulate")
+        parser.add_argument("--set", help="key=value to the global cfg, e.g. pushdown=True", action="append", dest="set", default=[])
+        parser.add_argument("--seed", help="Seed of the synthetic tickets and rules", action="store", dest="seed", default=1, type=int)
+        parser.add_argument("--label", help="Label of the results, e.g. the change measured", action="store", dest="label", default="")
+        parser.add_argument("--out", help="File to add the results to", action="store", dest="out", default="bench-results.jsonl")
+        parser.add_argument("--ts", help="TicketSupervisor.py to run", action="store", dest="ts", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),"TicketSupervisor.py"))
+        parser.add_argument("--work_dir", help="Directory for the cfg, rules and logs (default: temporary)", action="store", dest="work_dir", default="")
+        parser.add_argument("--keep", help="Keep the temporary work dir", action="store_true", dest="keep")
+        BenchTicketSupervisor(parser.parse_args(sys.argv[1:]))
+    except Exception as e:
+        prtmsg("Oops. Something went wrong ({}), DG: {}".format(type(e),str(e)),"091","E")
@@ -7,22 +7,35 @@
 
 * Prerequisites
     python (preferably v3)
+    pip install pyyaml
 
 * For windows exe build
     pip install pyinstaller
     pyinstaller --onefile ReportTicketSupervisor.py
 
-* Use: ReportTicketSupervisor [--csv] [--log_dir directory]
+* Use: ReportTicketSupervisor [--csv] [--log_dir directory] [--appname Paavo|"Paavo,Sirkku"|"*"] [--rebuild] [--cfg file]
 
+  Log files are read in one pass each, on a pool of processes. What was found per file is saved in
+  [log_dir]/.ReportTicketSupervisor.json; next time only new files and the new lines of grown
+  files are read (--rebuild reads all again). Matches are found by the message prefixes (msg_prefix)
+  of TicketSupervisor.cfg (--cfg; if not found, the one in log_dir).
+
+20261017: single pass per file, all message prefixes and robots, process pool, summary cache
+20261017: message prefixes from TicketSupervisor.cfg, summary cache kept for the other robots
 """
 ############################################################################################
-import argparse, sys, os, glob, datetime, re
+import yaml, argparse, sys, os, glob, datetime, re, json, tempfile, multiprocessing
 from collections import Counter
-VERSION="0.1.0"
+from concurrent.futures import ProcessPoolExecutor
+VERSION="0.2.0"
 mpfx="RPT"                                           # Mesage prefix
 csv=False                                            # If True, outputs as CSV
 log_dir="."                                          # Directory containing the log files
-appname="Paavo"                                      # Name of robot application
+appname="Paavo"                                      # Name of robot application, or list of them, or *
+rebuild=False                                        # If True, ignores the summary cache
+cfgfn="TicketSupervisor.cfg"                         # Cfg of the robots, for their message prefixes
+cache_name=".ReportTicketSupervisor.json"            # Summary cache in log_dir
+regex_logname=re.compile(r'^actions-(.+)-(2\d{7})\.log$')
 ############################################################################################
 def prtmsg(txt,mid="000",msuf="I"):
     '''Print a message to the console. Include a message prefix and timestamp'''
@@ -34,21 +47,104 @@ def OutputFormat():
         return ';"{}";{}'
     return "{:48s}\t{:8d}"
 
+def MsgPrefixes(cfgfn):
+    '''Message prefixes of the robots in TicketSupervisor.cfg: msg_prefix of global and of each robot,
+       besides the defaults PVE and RBT'''
+    whole={}
+    try:
+        with open(cfgfn,'r') as ymlf:
+            whole=yaml.load(ymlf,Loader=yaml.Loader) or {}
+    except (OSError,yaml.YAMLError) as e:
+        prtmsg("Cannot read {}, counting the matches of message prefixes PVE and RBT only, DG: {}".format(cfgfn,e),"011","W")
+    prefixes={"PVE","RBT"}                           # Default of the reports before, default of TicketSupervisor
+    for sect in (whole.values() if isinstance(whole,dict) else []):
+        if isinstance(sect,dict) and sect.get('msg_prefix'):
+            prefixes.add(str(sect['msg_prefix']))
+    return sorted(prefixes)
+
+def SummarizeLog(filen,offset=0,rules=None,prefixes=("PVE","RBT")):
+    '''Count matches per rule on a log file, from offset on, in one pass.
+       Return (offset after the last complete line, matches per rule).'''
+    rules=Counter(rules or {})
+    regex_matched=re.compile(b"^(?:"+b"|".join(re.escape(pfx.encode('utf-8')) for pfx in prefixes)+b")202I ")  # "PVE202I 17-183740 #INC0 == R1 - Test"
+    with open(filen,'rb') as logf:
+        logf.seek(offset)
+        for line in logf:
+            if not line.endswith(b"\n"):            # Being written right now, next time then
+                break
+            offset+=len(line)
+            matched=regex_matched.match(line)
+            if matched:
+                rules[line[matched.end():].split(b" ")[3].rstrip(b"\r\n").decode('utf-8','replace')]+=1
+    return offset,rules
+
+def ReadSummaries(log_dir):
+    '''Summaries of log files of the previous run: name -> {size, mtime, offset, rules}'''
+    try:
+        with open(os.path.join(log_dir,cache_name),'r') as cf:
+            return json.load(cf)
+    except (OSError,ValueError):
+        return {}
+
+def SaveSummaries(log_dir,sums):
+    '''Write the summaries to a temp file and rename it over the old one'''
+    tfd,tfile=tempfile.mkstemp(dir=log_dir,prefix=cache_name)
+    with os.fdopen(tfd,'w') as cf:
+        json.dump(sums,cf)
+    os.replace(tfile,os.path.join(log_dir,cache_name))
+
+def LogFiles(log_dir):
+    '''Log files of the robots in appname: name -> (robot, day)'''
+    robots=None if appname=="*" else set(appname.split(","))
+    files={}
+    for filen in glob.glob(os.path.join(log_dir,"actions-*-2*.log")):
+        name=os.path.basename(filen)
+        match=regex_logname.match(name)
+        if match and (robots is None or match.group(1) in robots):
+            files[name]=(match.group(1),datetime.datetime.strptime(match.group(2),'%Y%m%d'))
+    return files
+
 def ReportTicketSupervisor(log_dir):
     '''Process log files found on the directory.'''
     cd=Counter()
     ck=Counter()
-    mask=os.path.join(log_dir,"actions-{}-2*.log".format(appname))
-    for filen in glob.glob(mask):
-        yyyymmdd=filen.split("-")[2].split(".")[0]
-        day=datetime.datetime.strptime(yyyymmdd, '%Y%m%d')
-        num_match=open(filen, 'r').read().count("PVE202I")
+    files=LogFiles(log_dir)
+    prefixes=MsgPrefixes(cfgfn if os.path.isfile(cfgfn) else os.path.join(log_dir,os.path.basename(cfgfn)))
+    cached=ReadSummaries(log_dir)                    # Also of the other robots, kept
+    sums={} if rebuild else dict(cached)
+    todo={}                                          # name -> (offset, rules so far) of files to read
+    for name in files:
+        st=os.stat(os.path.join(log_dir,name))
+        old=sums.get(name)
+        if old and old.get('prefixes')!=prefixes:   # Counted by other prefixes, count again
+            old=None
+        if old and old['size']==st.st_size and old['mtime']==st.st_mtime:
+            continue                                 # Unchanged since last time
+        if old and old['size']<=st.st_size:
+            todo[name]=(old['offset'],old['rules'])  # Grown, read the new lines only
+        else:
+            todo[name]=(0,{})
+        sums[name]={'size': st.st_size, 'mtime': st.st_mtime, 'prefixes': prefixes}
+    if len(todo)>1:
+        with ProcessPoolExecutor() as pool:
+            results=dict(zip(todo,pool.map(SummarizeLog,[os.path.join(log_dir,name) for name in todo],
+                *zip(*todo.values()),[prefixes]*len(todo),chunksize=max(1,len(todo)//(4*(os.cpu_count() or 1))))))
+    else:
+        results={name: SummarizeLog(os.path.join(log_dir,name),*todo[name],prefixes) for name in todo}
+    for name,(offset,rules) in results.items():
+        sums[name].update(offset=offset,rules=rules)
+    if todo:
+        SaveSummaries(log_dir,{name: sm for name,sm in dict(cached,**sums).items() if os.path.isfile(os.path.join(log_dir,name))})
+    multi=len({robot for robot,day in files.values()})>1  # Rules of different robots apart
+    for name,(robot,day) in files.items():
+        rules=sums[name]['rules']
+        num_match=sum(rules.values())
         cd.update(
             {"{}".format(day.strftime("%Y-%m-%d")): num_match
             ,"vko_{}".format(day.strftime("%Y/%W")): num_match
             ,"kuu_{}".format(day.strftime("%Y-%m")): num_match
         })
-        _=[ ck.update({line.split(" ")[4]: 1}) for line in open(filen, 'r').read().split("\n") if re.search("PVE202I",line) ]
+        ck.update({"{}/{}".format(robot,rule) if multi else rule: cnt for rule,cnt in rules.items()})
 
     for key in sorted(cd.keys()):
         prtmsg(OutputFormat().format(key, cd[key]),mid="10-time-")
@@ -57,19 +153,24 @@ def ReportTicketSupervisor(log_dir):
     prtmsg(OutputFormat().format("*YHT",sum(ck.values())),mid="90-totl-")
 ############################################################################################
 if __name__ == '__main__':
+    multiprocessing.freeze_support()                 # Process pool on windows exe
     try:
         me=os.path.basename(sys.argv[0])
         if "--version" in sys.argv:
             prtmsg("Version: {} - {}".format(VERSION,me))
             sys.exit()
         parser=argparse.ArgumentParser(description='Reporter for Personal Assistant for ServiceNow Tickets.')
-        parser.add_argument("--appname", help="Name of virtual assistant", action="store", dest="appname", default="Paavo")
+        parser.add_argument("--appname", help="Name of virtual assistant, comma separated names or * for all", action="store", dest="appname", default="Paavo")
+        parser.add_argument("--rebuild", help="Read all log files again, ignoring the summary cache", action="store_true", dest="rebuild")
         parser.add_argument("--csv", help="Output as CSV", action="store_true", dest="csv")
         parser.add_argument("--log_dir", help="Directory containing log files", action="store", dest="log_dir", default=".")
+        parser.add_argument("--cfg", help="TicketSupervisor.cfg, for the message prefixes of the robots", action="store", dest="cfg", default=cfgfn)
         runa=parser.parse_args(sys.argv[1:])
         appname=runa.appname
         log_dir=runa.log_dir
         csv=runa.csv
+        rebuild=runa.rebuild
+        cfgfn=runa.cfg
         ReportTicketSupervisor(log_dir)
     except Exception as e:
         prtmsg("Oops. Something went wrong, {} on sick leave, DG: {}".format(appname,str(e)),"091","E")
@@ -9,29 +9,69 @@
 * Prerequisites
     python (preferably v3)
     pip install pyyaml,pysnow
+    pip install numpy                           # Optional, faster batch_eval
 
 * For windows exe build
     pip install pyinstaller pywin32
     pip install python-magic-bin==0.4.14
     pyinstaller --clean --noconfirm --onefile TicketSupervisor.py
 
-* Use: TicketSupervisor.py -s "[snc_instance]" -u "[snc_userid]" -p "[snc_password]" [--debug] [--simulate] [--once]
+* Use: TicketSupervisor.py -s "[snc_instance]" -u "[snc_userid]" -p "[snc_password]" [--debug] [--simulate] [--once] [--profile file] [--record file]
+       TicketSupervisor.py --replay file [--against [robot=]old_rule_file ...] [--replay_out file]
   ... or use the cfg file (desc below) to specify the things
 
 * TicketSupervisor.cfg format:
   global:
     snc: snc_instance_abbrev                    # 1st qualifier of SNC service name
+    snc_host: ""                                # Optional, full host[:port] instead of snc (use_ssl: True)
     user: snc_userid                            # Authorized SNC user id
     pwd: snc_password
     appname: ["Paavo","Sirkku"]                 # name of the robot
     proxy: http://your-proxy-name:8080          # In case proxy needed to connect
     cfg_dir: .                                  # Directory where ticket rule cfg is loacted ([appname].txt)
     log_dir: .                                  # If exists, will log into "actions-[appname].YYYYMMDD.log" there
-    sleep_sec_between: 20                       # Wait time between loops, unless --once
+    log_flush_sec: 5                            # Log lines are buffered, written to the log file at least this often
+    log_json: False                             # Also "actions-[appname]-YYYYMMDD.jsonl": robot, mid, num, rule, action, latency
+    sleep_sec_between: 20                       # Start a loop every 20 seconds, unless --once
+    sleep_min_sec: 20                           # After a loop with matching/changed tickets: next one in this time
+    sleep_max_sec: 20                           # Quiet loops stretch the time between them by 1.5 (sleep_stretch) up to this
+    retry_backoff_sec: 30                       # Retry on connection error after ~30 sec, then ~60, ~120 ... up to
+    retry_backoff_max_sec: 600                  # ... this, all with some jitter
     first_match_only: True                      # On True, stops scanning rules after 1st match
     ext_cmd_timeout: 30                         # Stop external script/program after 30 seconds
+    run1_concurrency: 4                         # External scripts/programs running at the same time, per robot
+    run1_spool_dir: ""                          # Directory for {tkt_json_file} files, default: temp dir
+    run1_stdin: False                           # Give the ticket as JSON on stdin of the script/program
     max_retry_connect: 15                       # Max number of consequent connection errors tolerated
     value_round_robin: False                    # use round-robin to pick values from list
+    multi_pattern_min: 24                       # Literals on a field to search with one automaton instead of one by one
+    snc_page_size: 333                          # Tickets read from SNC per request, all pages are read
+    incremental: False                          # Read only tickets updated since the previous round, skip unchanged
+    full_sync_sec: 3600                         # On incremental, read all qualifying tickets again this often
+    incremental_overlap_sec: 60                 # On incremental, read again tickets updated this long before the mark
+    snc_utc_offset_h: 0                         # On incremental, UTC offset of the time zone of the SNC user (e.g. -5, 5.5)
+    pushdown: False                             # Let SNC select only tickets that may match a rule
+    pushdown_time_margin_h: 24                  # On pushdown, widen "@now ..." windows by this (time zones)
+    pushdown_max_len: 4000                      # On pushdown, longest query; if longer, no pushdown
+    http_pool_size: 32                          # Keep-alive connections to SNC, all robots and workers
+    http_retries: 3                             # Retries of reading tickets on 429/5xx/connection error (http_backoff_sec: 0.5)
+    update_concurrency: 8                       # Ticket updates (PATCH) running at the same time, all robots
+    update_rate: 10                             # Ticket updates per second at most, all robots (update_burst: 10)
+    update_retries: 4                           # Retries of an update on 429/5xx/connection error (adding a note: 429/no connection)
+    update_backoff_sec: 1                       # 1st retry after ~1 sec, then 2, 4, ...
+    journal_file: ""                            # If set (e.g. journal.db), rules are not acted on again until the ticket changes
+    journal_ttl_h: 168                          # Journal entries are dropped after a week
+    cluster_store: ""                           # If set (e.g. /shared/cluster.db), instances using it share the tickets
+    cluster_member: ""                          # Name of this instance in the cluster, default: [host]-[pid]
+    cluster_lease_sec: 30                       # An instance not heard of this long is out, its tickets move
+    batch_eval: False                           # Read all tickets of a round first, then evaluate each rule over all at once
+    round_stats: False                          # Log tickets and seconds spent on fetch/match/act after each round
+    metrics_port: 0                             # Serve Prometheus metrics on http://127.0.0.1:[port]/metrics (metrics_host)
+    stats_dump_sec: 0                           # Log statistics of the robots and their rules this often
+    webhook_port: 0                             # Process tickets notified on http://127.0.0.1:[port]/[robot] (webhook_host)
+    webhook_token: ""                           # If set, notifications need it on header X-Webhook-Token
+    webhook_debounce_ms: 300                    # Notifications of a ticket within this time are processed once
+    webhook_reconcile_sec: 600                  # With webhook, read all tickets this often (instead of sleep_sec_between)
   Paavo:                                       ## Cfg entries overriding global ones for "Paavo"
     snc_state_ignore: "6"                       # Status(es) to ignore on fetching tickets
     snc_table: "incident"                       # Name of SNC table to work on
@@ -60,6 +100,7 @@
   - [snc_field]: "=[exact full value]"           # assigned_to: "="               = not assigned to anyone
   - [snc_field]: "@[datetime] [arithmetics]"     # updated_at:  "^@now - 12h30m"  = not between now and offset
   - [snc_field]: "^~{variable}"                  # snc_field, env_var, or vars file keyword as exclusive regexp
+  - [snc_field]: ["[value1]","=[value2]"]        # any of the values (each with its own prefix) matches
   act:                                        (list of actions)
   - nop
   - update:
@@ -76,12 +117,36 @@ License: MIT
 20200408: v2.0 with support for multiple robots / task types
 20200527: v2.1 with optional round-robin value picker from list
 20210630: v2.2 adjust cfg scoping on SNC setup
+20261017: v2.3 rules compiled once into matcher objects, cached on rule file mtime
+20261017: multi-pattern scan of rule literals and regexps per ticket field
+20261017: optional incremental polling on sys_updated_on, unchanged tickets are not evaluated again
+20261017: tickets read page by page (no longer capped at 333) and only the fields the rules refer to
+20261017: optional pushdown of rule conditions to the SNC query; list values in find match any of them
+20261017: robots run side by side on threads of their own, each with its own cadence
+20261017: ticket updates as rate limited, retried PATCH by sys_id on a pool of workers
+20261017: run1 commands on a pool of workers per robot, stopped with their children on timeout
+20261017: log files kept open and buffered, optional JSON lines log
+20261017: round-robin positions kept in memory, saved at end of round by write & rename
+20261017: cfg, rule and vars files read again only when changed; cfg changes taken into use between rounds
+20261017: snc_host and round_stats for BenchTicketSupervisor
+20261017: metrics (latency histograms, rule CPU, API calls, overruns) on HTTP and to log, --profile
+20261017: loops started on a cadence that adapts to activity, connection retries backed off with jitter
+20261017: optional webhook for ticket notifications, processed right away; polling then to reconcile
+20261017: optional journal of actions, a rule is not acted on again until the ticket has changed
+20261017: optional cluster of instances sharing the tickets by sys_id hash, with leases in a lock store
+20261017: optional batch evaluation of rules over ticket columns, with numpy if installed
+20261017: --record tickets read to a snapshot, --replay rules on it offline
+20261017: pooled connections with retries of GETs; tickets read at start used on the first round; pysnow imported on connecting
 """
 ############################################################################################
-import yaml, pysnow, requests, argparse, os, sys, platform, json, time, re, tempfile, subprocess, glob, random, copy
+import yaml, argparse, os, sys, platform, json, time, re, tempfile, subprocess, glob, random, string, threading, signal, itertools, atexit
+import bisect, io, hmac, sqlite3, hashlib, gzip, zlib, mmap, multiprocessing, abc
+from collections import ChainMap, Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import timedelta,datetime
-from requests.exceptions import ConnectionError
-VERSION="2.2.0"
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+VERSION="2.3.0"
 mpfx0="RBT"                                          # Default message prefix
 mpfx="RBT"                                           # Current message prefix
 appname="Paavo"                                      # Name of current robot, used for rule file and output
@@ -89,17 +154,104 @@ robotname="Paavo"
 debug=False                                          # If True, writes verbosely
 quiet=False                                          # If True, shows only matching tickets
 simulation=False                                     # If True, does not perform actions
+rule_cpu=False                                       # If True, CPU time of each rule on each ticket is measured
 whole_cfg={'global': {'dummy': 'null'}}
 log_dir=""                                           # If has a value, writes log
+cfgfn="TicketSupervisor.cfg"
+rule_cache={}                                        # Compiled rules per rule file: (rules read, cfg, subargs, rules)
+subargs_cache={}                                     # Substitution vars per robot: (vars files read, vars, files)
+current=threading.local()                            # current.robot: RobotContext the thread works for
+msg_lock=threading.Lock()                            # One message at a time from all threads
+spool_seq=itertools.count()                          # Unique names of run1 spool files
+logw=None                                            # LogWriter, set below
+snapshot=None                                        # SnapshotWriter on --record
+replay_at=None                                       # On --replay, the time the ticket was recorded ("@now" finds)
 regex_timedelta = re.compile(r'^((?P<days>[\.\d]+?)d)?((?P<hours>[\.\d]+?)h)?((?P<minutes>[\.\d]+?)m)?((?P<seconds>[\.\d]+?)s)?$')
 ############################################################################################
-def prtmsg(txt,mid="000",msuf="I"):
-    '''Print a message to the console. Include a message prefix and timestamp'''
-    logstr="{}{}{} {} {}".format(mpfx,mid,msuf,datetime.now().strftime('%d-%H%M%S'),txt)
-    if log_dir:                                       # Output to file as well if log_dir on cfg
-        with open(os.path.join(log_dir,"actions-{}-{}.log".format(robotname,datetime.now().strftime('%Y%m%d'))),"a") as logf:
-            logf.write("{}\n".format(logstr))
-    print(logstr)
+def ImportSnc():
+    '''Import pysnow and requests on connecting; --version and --replay start without them'''
+    global pysnow,requests,ConnectionError
+    import pysnow, requests
+    from requests.exceptions import ConnectionError
+
+def CurrentRobot():
+    '''Name and message prefix of the robot the current thread works for'''
+    rbt=getattr(current,'robot',None)
+    if rbt is None:
+        return robotname,mpfx
+    return rbt.name,rbt.mpfx
+
+class LogWriter(object):
+    '''Writer of the log files of the robots in log_dir: actions-[robot]-YYYYMMDD.log and, on log_json, the same
+       messages as JSON lines to actions-[robot]-YYYYMMDD.jsonl. The files are kept open and written through a
+       buffer, flushed every log_flush_sec seconds, at the end of each round and at exit; new files at date change.
+       Call with msg_lock held.'''
+    def __init__(self):
+        self.files={}                                 # (robot, ext) -> (YYYYMMDD, open file)
+        self.interval=5.0                             # log_flush_sec
+        self.json=False                               # log_json
+        self.flushed=time.monotonic()
+
+    def configure(self,cfg):
+        self.interval=float(cfg.get('log_flush_sec',5))
+        self.json=bool(cfg.get('log_json',False))
+
+    def file(self,rname,ext,day):
+        '''Open log file of the robot for the day, closing the one of the previous day'''
+        old=self.files.get((rname,ext))
+        if old is not None and old[0]==day:
+            return old[1]
+        if old is not None:
+            old[1].close()
+        logf=open(os.path.join(log_dir,"actions-{}-{}.{}".format(rname,day,ext)),"a",encoding="utf-8" if ext=="jsonl" else None)
+        self.files[(rname,ext)]=(day,logf)
+        return logf
+
+    def write(self,rname,logstr,rec):
+        day=rec['ts'][0:10].replace('-','')
+        self.file(rname,"log",day).write("{}\n".format(logstr))
+        if self.json:
+            self.file(rname,"jsonl",day).write("{}\n".format(json.dumps(rec)))
+        if time.monotonic()-self.flushed>=self.interval:
+            self.flush()
+
+    def flush(self):
+        for day,logf in self.files.values():
+            logf.flush()
+        self.flushed=time.monotonic()
+
+    def close(self):
+        for day,logf in self.files.values():
+            logf.close()
+        self.files={}
+
+def FlushLog(due_only=False):
+    '''Write buffered log lines to the log files (due_only: only if log_flush_sec has passed)'''
+    with msg_lock:
+        if not due_only or time.monotonic()-logw.flushed>=logw.interval:
+            logw.flush()
+
+def CloseLog():
+    with msg_lock:
+        logw.close()
+
+def prtmsg(txt,mid="000",msuf="I",num=None,rule=None,action=None,latency=None):
+    '''Print a message to the console. Include a message prefix and timestamp.
+       num, rule, action and latency (sec) go to the JSON lines log as such.'''
+    rname,rpfx=CurrentRobot()
+    now=datetime.now()
+    logstr="{}{}{} {} {}".format(rpfx,mid,msuf,now.strftime('%d-%H%M%S'),txt)
+    with msg_lock:
+        if log_dir:                                   # Output to file as well if log_dir on cfg
+            if num is None and txt.startswith("#"):   # Ticket messages start with #[number]
+                num=txt[1:].split(" ",1)[0]
+            rec={'ts': now.isoformat(timespec='milliseconds'), 'robot': rname, 'mid': "{}{}{}".format(rpfx,mid,msuf),
+                 'num': num, 'rule': rule, 'action': action, 'latency': None if latency is None else round(latency,3), 'txt': txt}
+            logw.write(rname,logstr,rec)
+        print(logstr)
+
+logw=LogWriter()
+atexit.register(CloseLog)
 
 def dbgmsg(txt,mid="800",msuf="D"):
     '''Print a message in case we have debugging on'''
@@ -127,185 +279,1257 @@ def SelectSingleValue(val,robotname,key,cfg):              # Picks a value to us
     if type(val) is not list:                              # For single item,
         return val                                         # ... use it
     if cfg.get('value_round_robin',False):                 # Use round robin?
-        ix=0                                               # ... determine which one to use next
-        statefile=GetCfgFileName("z_state_{}".format(robotname))
-        states={}
-        try:
-            if os.path.isfile(statefile):
-                states=ReadCfg(statefile)                  # read current ix values
-        except Exception as e:
-            prtmsg("{} {} ?!? {}".format(robotname,key,e),"084","W")
-        pick1=states.get(key,-1)+1                         # default=0, else +1
-        if pick1>=len(val):                                # if beyond
-            pick1=0                                        # ... start over
-        states[key]=pick1
-        try:
-            with open(statefile,'w') as save_state:        # store the current value to file
-                yaml.dump(states,save_state,default_flow_style=False)
-        except Exception as e:
-            prtmsg("{} {} ?!? {}".format(robotname,key,e),"085","W")
-        use1=val[pick1]
+        statefile=GetCfgFileName("z_state_{}".format(robotname),cfg)
+        use1=val[round_robin.pick(statefile,robotname,key,len(val))]
         dbgmsg("{} <- {}".format(use1,val),"083")          # and use it this round
     else:                                                  # no round robin, pick random
         use1=random.choice(val)                            # pick randomly one value from the list
         dbgmsg("{} <- {}".format(use1,val),"082")          # and use it this round
     return use1
 
-def GetSubArgs(robotname,cfg):
+class RoundRobinState(object):
+    '''Round-robin positions of value lists, per state file (z_state_[rule].txt) and field. Each state file is
+       read once, the positions are kept in memory and the changed files are written at the end of each round
+       (and at exit), to a temp file renamed over the old one.'''
+    def __init__(self):
+        self.states={}                                     # statefile -> {field: ix last used}
+        self.dirty=set()
+        self.lock=threading.Lock()                         # Robots pick values side by side
+
+    def pick(self,statefile,robotname,key,count):
+        '''Next position for the field, 0...count-1'''
+        with self.lock:
+            states=self.states.get(statefile)
+            if states is None:
+                states={}
+                try:
+                    if os.path.isfile(statefile):
+                        states=ReadCfg(statefile) or {}    # read current ix values
+                except Exception as e:
+                    prtmsg("{} {} ?!? {}".format(robotname,key,e),"084","W")
+                self.states[statefile]=states
+            pick1=states.get(key,-1)+1                     # default=0, else +1
+            if pick1>=count:                               # if beyond
+                pick1=0                                    # ... start over
+            states[key]=pick1
+            self.dirty.add(statefile)
+            return pick1
+
+    def save(self):
+        '''Store the changed positions to their files'''
+        with self.lock:
+            for statefile in sorted(self.dirty):
+                tfile=""
+                try:
+                    tfd,tfile=tempfile.mkstemp(dir=os.path.dirname(statefile) or ".",prefix=".z_state_")
+                    with os.fdopen(tfd,'w') as save_state:
+                        yaml.dump(self.states[statefile],save_state,default_flow_style=False)
+                    os.replace(tfile,statefile)            # Old or new file, never half of one
+                except Exception as e:
+                    prtmsg("{} ?!? {}".format(statefile,e),"085","W")
+                    if tfile and os.path.isfile(tfile):
+                        os.remove(tfile)
+            self.dirty=set()
+
+round_robin=RoundRobinState()
+atexit.register(round_robin.save)
+
+class ActionJournal(object):
+    '''Rules acted on per robot and ticket, with sys_updated_on of the ticket then, in sqlite (journal_file).
+       The journal is read into memory once; a rule is not acted on again until the ticket has been changed
+       by someone else than us: our own updates are journaled too, with the sys_updated_on they produced.
+       New entries are committed at the end of each round; entries older than journal_ttl_h are dropped.'''
+    def __init__(self,path,ttl_h=168):
+        self.lock=threading.Lock()                         # Update workers journal their results
+        self.ttl=float(ttl_h)*3600
+        self.expired=0.0                                   # time.time() of the latest expiry
+        self.db=sqlite3.connect(path,check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("create table if not exists acted (robot text, sys_id text, rule text, updated_on text, at real, primary key (robot,sys_id,rule))")
+        self.db.execute("create table if not exists own (robot text, sys_id text, updated_on text, at real, primary key (robot,sys_id))")
+        self.expire()
+        self.acted={(rbt,sid,rle): (upd,at) for rbt,sid,rle,upd,at in self.db.execute("select * from acted")}
+        self.own={(rbt,sid): (upd,at) for rbt,sid,upd,at in self.db.execute("select * from own")}
+
+    def done(self,robot,tkt,rule):
+        '''True if the rule has been acted on this version of the ticket (or on one we updated ourselves since)'''
+        ent=self.acted.get((robot,tkt.get('sys_id'),rule))
+        if ent is None:
+            return False
+        upd=tkt.get('sys_updated_on')
+        if ent[0]==upd:
+            return True
+        own=self.own.get((robot,tkt.get('sys_id')))
+        return own is not None and own[0]==upd and own[1]>=ent[1]
+
+    def record(self,robot,tkt,rule,at=None):
+        '''The rule was acted on the ticket, starting at time.time() at'''
+        ent=(tkt.get('sys_updated_on'),at or time.time())
+        with self.lock:
+            self.acted[(robot,tkt.get('sys_id'),rule)]=ent
+            self.db.execute("insert or replace into acted values (?,?,?,?,?)",(robot,tkt.get('sys_id'),rule)+ent)
+
+    def updated(self,robot,sys_id,updated_on):
+        '''We updated the ticket, now at sys_updated_on updated_on (unless a later update of ours finished first)'''
+        if not updated_on:
+            return
+        ent=(updated_on,time.time())
+        with self.lock:
+            old=self.own.get((robot,sys_id))
+            if old is not None and old[0]>updated_on:         # "YYYY-MM-DD HH:MM:SS" in order as text
+                return
+            self.own[(robot,sys_id)]=ent
+            self.db.execute("insert or replace into own values (?,?,?,?)",(robot,sys_id)+ent)
+
+    def expire(self):
+        '''Drop entries older than TTL (at most once in ten minutes)'''
+        now=time.time()
+        if now-self.expired<600:
+            return
+        self.expired=now
+        cutoff=now-self.ttl
+        self.db.execute("delete from acted where at<?",(cutoff,))
+        self.db.execute("delete from own where at<?",(cutoff,))
+        for ents in (getattr(self,'acted',{}),getattr(self,'own',{})):
+            for key in [key for key,ent in ents.items() if ent[1]<cutoff]:
+                del ents[key]
+
+    def save(self):
+        '''Commit the entries of the round'''
+        with self.lock:
+            try:
+                self.expire()
+                self.db.commit()
+            except Exception as e:
+                prtmsg("Journal ?!? {}".format(e),"086","W")
+
+class LockStore(abc.ABC):
+    '''Where the members of a cluster keep their leases and ticket claims. For another store (e.g. a database
+       server), subclass this, add it to lock_stores and give it as cluster_store: "[kind]:[where]".'''
+    @abc.abstractmethod
+    def renew(self,member,lease_sec):
+        '''Extend the lease of member by lease_sec, return the members with a lease alive, sorted'''
+
+    @abc.abstractmethod
+    def leave(self,member):
+        '''End the lease of member'''
+
+    @abc.abstractmethod
+    def claim(self,key,member,lease_sec):
+        '''Claim key (sys_id) for member for lease_sec, True unless another member holds it'''
+
+class SqliteLockStore(LockStore):
+    '''Leases in a sqlite file shared by the members: on one host, or on a shared disk with working file locks.
+       Leases are on wall clock time, the hosts need to have their clocks in sync.'''
+    def __init__(self,path):
+        self.lock=threading.Lock()
+        self.db=sqlite3.connect(path,timeout=30,check_same_thread=False,isolation_level=None)
+        self.db.execute("create table if not exists members (member text primary key, until real)")
+        self.db.execute("create table if not exists claims (key text primary key, member text, until real)")
+
+    def transaction(self,fn,*args):
+        '''Run fn on the db in a write transaction of its own'''
+        with self.lock:
+            self.db.execute("begin immediate")             # Other members wait (timeout) instead of failing
+            try:
+                ret=fn(time.time(),*args)
+                self.db.execute("commit")
+                return ret
+            except Exception:
+                self.db.execute("rollback")
+                raise
+
+    def renew(self,member,lease_sec):
+        def renew1(now,member,lease_sec):
+            self.db.execute("insert or replace into members values (?,?)",(member,now+lease_sec))
+            self.db.execute("delete from members where until<?",(now,))
+            self.db.execute("delete from claims where until<?",(now,))
+            return [row[0] for row in self.db.execute("select member from members order by member")]
+        return self.transaction(renew1,member,lease_sec)
+
+    def leave(self,member):
+        def leave1(now,member):
+            self.db.execute("delete from members where member=?",(member,))
+            self.db.execute("delete from claims where member=?",(member,))
+        self.transaction(leave1,member)
+
+    def claim(self,key,member,lease_sec):
+        def claim1(now,key,member,lease_sec):
+            row=self.db.execute("select member,until from claims where key=?",(key,)).fetchone()
+            if row is not None and row[0]!=member and row[1]>=now:
+                return False
+            self.db.execute("insert or replace into claims values (?,?,?)",(key,member,now+lease_sec))
+            return True
+        return self.transaction(claim1,key,member,lease_sec)
+
+lock_stores={'sqlite': SqliteLockStore}                    # cluster_store "[kind]:[where]" -> LockStore
+
+def LockStoreFor(spec):
+    '''LockStore of cluster_store, a plain path is a sqlite file'''
+    kind,sep,where=spec.partition(":")
+    if not sep or kind not in lock_stores:                 # e.g. C:\shared\cluster.db
+        kind,where='sqlite',spec
+    return lock_stores[kind](where)
+
+class Cluster(object):
+    '''Membership of this instance in a cluster of TicketSupervisors sharing the work (cluster_store). Each
+       ticket belongs to one live member, by rendezvous hashing of its sys_id over the members: when one joins,
+       leaves or lets its lease run out, only the tickets of that one move. The lease is renewed on a thread
+       of its own every third of cluster_lease_sec. While the members see the membership differently, a claim
+       of the ticket in the store keeps two of them from acting on it.'''
+    def __init__(self,store,member,lease_sec=30):
+        self.store=store
+        self.member=member
+        self.lease=float(lease_sec)
+        self.members=[]                                    # Members with a lease alive, sorted
+        self.valid_until=0.0                               # time.monotonic() our own lease is known to last
+        self.generation=0                                  # Changes of the members, tickets moved
+        self.stopping=threading.Event()
+
+    def heartbeat(self):
+        '''Renew our lease, take the live members'''
+        clk=time.monotonic()
+        try:
+            members=self.store.renew(self.member,self.lease)
+        except Exception as e:
+            prtmsg("Cluster store ?!? {}".format(e),"018","W")
+            return
+        self.valid_until=clk+self.lease
+        if members!=self.members:
+            self.members=members
+            self.generation+=1
+            prtmsg("Cluster of {} members, me {}: {}".format(len(members),self.member,", ".join(members)),"017")
+
+    def start(self):
+        '''Join the cluster, keep the lease on until exit'''
+        self.heartbeat()
+        threading.Thread(target=self.run,name="cluster",daemon=True).start()
+        atexit.register(self.leave)
+
+    def run(self):
+        while not self.stopping.wait(self.lease/3):
+            self.heartbeat()
+
+    def leave(self):
+        '''Leave the cluster, the others take over our tickets on their next heartbeat'''
+        self.stopping.set()
+        try:
+            self.store.leave(self.member)
+        except Exception as e:
+            prtmsg("Cluster store ?!? {}".format(e),"018","W")
+
+    def mine(self,sys_id):
+        '''True if the ticket is ours to work on'''
+        if time.monotonic()>self.valid_until:              # Lease lost, the others have taken over
+            return False
+        members=self.members
+        if len(members)==1:
+            return members[0]==self.member
+        return max(members,key=lambda mbr: hashlib.md5("{}/{}".format(mbr,sys_id).encode()).digest())==self.member
+
+    def claim(self,sys_id):
+        '''Claim the ticket before acting on it, False if another member is on it'''
+        try:
+            return self.store.claim(sys_id,self.member,self.lease)
+        except Exception as e:
+            prtmsg("Cluster store ?!? {}".format(e),"018","W")
+            return False
+
+def GetSubArgs(robotname,cfg,reloaded=None):
     '''Build a dict of values eligible for substitution; using global vars and *-vars-*.txt files.
        In case of values with lists, pick one random value from the list.
+       The same dict is returned as long as no vars file has changed.
     '''
-    dta={}
     masks=[os.path.join(cfg.get('cfg_dir',"."),"{}-vars-*.txt".format(robotname))
         ,os.path.join(cfg.get('cfg_dir',"."),"Global-vars-*.txt")]
-    for mask in masks:
-        for filen in glob.glob(mask):          # Read in all vars files
-            dbgmsg("Vars @ {}".format(filen),"181")
-            dta.update(yaml.load(open(filen,'r'),Loader=yaml.Loader))
+    files=[(filen,cfg_files.load(filen,reloaded)) for mask in masks for filen in glob.glob(mask)]
+    key=tuple((filen,id(vrs)) for filen,vrs in files)
+    cached=subargs_cache.get(robotname)
+    if cached and cached[0]==key:
+        return cached[1]
+    dta={}
+    for filen,vrs in files:                    # Read in all vars files
+        dbgmsg("Vars @ {}".format(filen),"181")
+        dta.update(vrs or {})
+    dbgmsg("Vars: {}".format(dta),"182")       # ENV vars not shown, they may have secrets
     dta.update(os.environ)                     # ...and add ENV vars
-    dbgmsg("Vars: {}".format(dta),"182")
+    subargs_cache[robotname]=(key,dta,files)   # files keep the ids in key valid
     return dta
 
 def CmdResultOutput(num,btes,mid):
     '''Print response of an external command'''
     if btes is None:
         return ""
-    txt=btes.decode('utf-8')
+    txt=btes.decode('utf-8',errors='replace')
     for line in txt.replace('\r','').split('\n'):
         if line:
             prtmsg("#{} -> ... {}".format(num,line),mid)
 
 def ReadCfg(cfgfile):
-    '''Read the configuration file, done on each 10sec main loop'''
-    ymlcfg=yaml.load(open(cfgfile,'r'),Loader=yaml.Loader)
+    '''Read the configuration file'''
+    with open(cfgfile,'r') as ymlf:
+        ymlcfg=yaml.load(ymlf,Loader=yaml.Loader)
     return ymlcfg
 
+class CfgFiles(object):
+    '''Parsed YAML files (TicketSupervisor.cfg, rules, vars) by path. A file is read again only when its
+       mtime or size changes; until then the very same object is returned, so users can compare by identity.'''
+    def __init__(self):
+        self.files={}                                      # path -> ((mtime, size), parsed content)
+        self.lock=threading.Lock()                         # Robots load side by side
+
+    def load(self,path,reloaded=None):
+        '''Content of a YAML file; path appended to reloaded if it was (re)read'''
+        st=os.stat(path)
+        stamp=(st.st_mtime_ns,st.st_size)
+        with self.lock:
+            cached=self.files.get(path)
+            if cached and cached[0]==stamp:
+                return cached[1]
+        data=ReadCfg(path)
+        with self.lock:
+            self.files[path]=(stamp,data)
+        if reloaded is not None:
+            reloaded.append(path)
+        return data
+
+cfg_files=CfgFiles()
+
 def GetUserName():
     '''Figure out running user name from selected env vars'''
     for varname in ['USERNAME','LOGNAME']:
         if varname in os.environ:
             return os.environ[varname]
 
-def GetCfgFileName(robotname):
+def GetCfgFileName(robotname,cfg):
     return os.path.join(cfg.get('cfg_dir',"."),"{}.txt".format(robotname))
 
-def EffectiveCfgForOneRobot(robotname):
+def EffectiveCfgForOneRobot(robotname,whole=None):
     '''Append robot specific to global cfg and return'''
+    if whole is None:
+        whole=whole_cfg
     cfg1={}
     for rob1 in ["global",robotname]:       # Pick sections to active cfg for this robot
-        if rob1 in whole_cfg:
-            for key, value in whole_cfg[rob1].items():
+        if rob1 in whole:
+            for key, value in whole[rob1].items():
                 cfg1[key]=value
     return cfg1
 ############################################################################################
+def NormText(txt,icase):
+    '''Normalize a string before comparing: optionally lower case, newlines replaced with blanks'''
+    if icase:
+        txt=txt.lower()
+    return txt.replace('\n',' ').replace('\r','')
+
+@lru_cache(maxsize=1024)
+def ReCompile(pattern,icase):
+    '''Compile a regexp once, also the ones taken from a ticket field, e.g. "~*u_stopwords"'''
+    return re.compile(pattern,re.I if icase else 0)
+
+class TicketView(dict):
+    '''Normalized string values of a ticket, computed once per field and only on first use.
+       lits/rxs: per field results of the multi-pattern scan of RuleSet.scan, if done
+       recheck: earliest time a tested "@now ..." window may flip for this ticket, or None
+    '''
+    __slots__=('tkt','icase','lits','rxs','recheck')
+    def __init__(self,tkt,icase):
+        self.tkt=tkt
+        self.icase=icase
+        self.lits={}
+        self.rxs={}
+        self.recheck=None
+    def __missing__(self,key):
+        val=NormText("{}".format(self.tkt[key]),self.icase)
+        self[key]=val
+        return val
+    def window(self,val2,delta,minus):
+        '''Note when the time window [now-delta, now] (or [now, now+delta]) starts or stops covering val2'''
+        try:
+            ts_2=datetime.strptime(val2[:19],"%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return
+        self.window_at(ts_2,delta,minus)
+    def window_at(self,ts_2,delta,minus):
+        '''As window, for a time parsed already'''
+        now=datetime.now()
+        for flip in ((ts_2,ts_2+delta) if minus else (ts_2-delta,ts_2)):
+            flip+=timedelta(seconds=1)
+            if flip>now and (self.recheck is None or flip<self.recheck):
+                self.recheck=flip
+
+class Predicate(namedtuple('Predicate','key kind negate value ref regex base delta minus error')):
+    '''A single compiled find entry of a rule, e.g. description: "^~please|kind".
+       kind: in (contains), re (regexp), eq (exact), btw (between times), any (value is a list, any of them),
+       dyn (ticket values to be substituted first) or err (could not be compiled, raised again on each test as before)
+    '''
+    __slots__=()
+    def test(self,tv,runargs):
+        '''Return True if the ticket (as TicketView) satisfies this predicate'''
+        if self.kind=="any":                                   # e.g. state: ["1","2"]
+            return any(alt.test(tv,runargs) for alt in self.value)
+        if self.kind=="dyn":                                   # Substitute from ticket, then parse as usual
+            val1=self.value
+            try:
+                val1=val1.format_map(runargs)
+            except Exception:
+                pass
+            return ParsePredicate(self.key,val1,tv.icase).test(tv,runargs)
+        if self.kind=="err":
+            raise self.error
+        val2=tv[self.key]
+        cmtcc="^" if self.negate else ""
+        if self.kind=="btw":
+            if self.base=="now":
+                ts_1=(replay_at or datetime.now()).replace(microsecond=0)
+                tv.window(val2,self.delta,self.minus)
+            elif isinstance(self.base,datetime):
+                ts_1=self.base
+            else:                                              # from a field on the ticket
+                ts_1=datetime.strptime("{}".format(tv.tkt[self.base[1:]]),"%Y-%m-%d %H:%M:%S")
+            if self.minus:
+                ts_1,ts_2=ts_1-self.delta,ts_1
+            else:
+                ts_2=ts_1+self.delta
+            val1=str(ts_1)
+            val1b=str(ts_2)
+            matched=bool(val1<=val2 and val1b>=val2) ^ self.negate
+            if debug:
+                dbgmsg("? {}: {} {}[{} ... {}]".format(matched,val2,cmtcc,val1,val1b),"382")
+            return matched
+        val1=self.value if self.ref is None else tv[self.ref]
+        if self.kind=="re":
+            scan=tv.rxs.get(self.key) if self.regex else None
+            if scan and val1 in scan[0]:                       # Known by the combined regexp scan
+                matched=(val1 in scan[1] or (not scan[2] and bool(self.regex.search(val2)))) ^ self.negate
+            else:
+                matched=bool((self.regex or ReCompile(val1,tv.icase)).search(val2)) ^ self.negate
+        elif self.kind=="eq":
+            matched=bool(val1==val2) ^ self.negate
+        else:
+            scan=tv.lits.get(self.key) if self.ref is None else None
+            if scan and val1 in scan[0]:                       # Known by the literal scan
+                matched=(val1 in scan[1]) ^ self.negate
+            else:
+                matched=bool(val1 in val2) ^ self.negate
+        if debug:
+            dbgmsg("? {}: {}'{}' {}{} '{}'".format(matched,self.key[0:35],val2[0:35],cmtcc,"=" if self.kind=="eq" else "~",val1[0:35]),"382")
+        return matched
+
+class CompiledRule(namedtuple('CompiledRule','name find act rule')):
+    '''A rule of [appname].txt with its find entries compiled into Predicates, rule = the original entry'''
+    __slots__=()
+
+@lru_cache(maxsize=4096)
+def ParsePredicate(key,val1,icase):
+    '''Parse the prefixes (^ ~ = @ *) of an already substituted find value into a Predicate'''
+    try:
+        negate=False
+        if bool(len(val1)) and val1[0] == '^':                 # e.g. "^Foo"
+            negate=True
+            val1=val1[1:]
+        kind="in"
+        if bool(len(val1)) and val1[0] == "~":                 # e.g. "~Foo|Bar" (regexp)
+            kind="re"
+            val1=val1[1:]
+        elif bool(len(val1)) and val1[0] == "=":               # e.g. "=Foo" (exact value)
+            kind="eq"
+            val1=val1[1:]
+        elif bool(len(val1)) and val1[0] == "@":               # e.g. "@now - 24h" (between time)
+            btw_attrs=val1[1:].split(" ")
+            base=btw_attrs[0]                                  # now, *field or YYYY-MM-DD HH:MM:SS
+            if base!="now" and base[:1]!="*":
+                base=datetime.strptime(base,"%Y-%m-%d %H:%M:%S")
+            delta=parse_time(btw_attrs[2])
+            return Predicate(key,"btw",negate,"",None,None,base,delta,btw_attrs[1] == "-",None)
+        if bool(len(val1)) and val1[0] == '*':                 # e.g. "*sys_created_by", "^*sys_updated_at"
+            return Predicate(key,kind,negate,"",val1[1:],None,None,None,False,None)
+        if kind=="re":
+            val1=val1.replace('\n',' ').replace('\r','')
+            return Predicate(key,kind,negate,val1,None,ReCompile(val1,icase),None,None,False,None)
+        return Predicate(key,kind,negate,NormText(val1,icase),None,None,None,None,False,None)
+    except Exception as e:
+        return Predicate(key,"err",False,val1,None,None,None,None,False,e)
+
+def TemplateRoots(txt):
+    '''Names of the variables a "text {var} text" template refers to, "" for positional ones'''
+    try:
+        return [re.split(r'[.\[]',fld,1)[0] for _,fld,_,_ in string.Formatter().parse(txt) if fld is not None]
+    except ValueError:
+        return []
+
+def CompilePredicate(key,val,subargs,icase):
+    '''Compile a find entry. Substitutions from vars/ENV are done now, the ones needing ticket fields on test'''
+    if isinstance(val,list):                                   # Alternatives, any of them to match
+        alts=tuple(CompilePredicate(key,val1,subargs,icase) for val1 in val)
+        return Predicate(key,"any",False,alts,None,None,None,None,False,None)
+    val1="{}".format(val)
+    try:
+        fields=[(fld,spec) for _,fld,spec,_ in string.Formatter().parse(val1) if fld is not None]
+    except ValueError:                                         # Not a valid template, used as is
+        fields=[]
+    roots=[re.split(r'[.\[]',fld,1)[0] for fld,_ in fields]
+    if any(not root or root.isdigit() for root in roots):      # Positional fields never substitute
+        pass
+    elif any(root not in subargs or '{' in (spec or "") for root,(_,spec) in zip(roots,fields)):
+        return Predicate(key,"dyn",False,val1,None,None,None,None,False,None)
+    elif fields:
+        try:
+            val1=val1.format_map(subargs)
+        except Exception:
+            pass
+    return ParsePredicate(key,val1,icase)
+
+def Predicates(find):
+    '''All predicates of a compiled find list, alternatives of "any" included'''
+    for prd in find:
+        if prd.kind=="any":
+            yield from Predicates(prd.value)
+        else:
+            yield prd
+
+def PushdownClause(prd,icase,margin):
+    '''Conditions (ORed) for ServiceNow to select at least every ticket the predicate may match, or None.
+       Each is (field, QueryBuilder method, argument); a timedelta argument stands for now - timedelta.'''
+    if prd.kind=="any":
+        clause=[]
+        for alt in prd.value:
+            cond=PushdownClause(alt,icase,margin)
+            if not cond:                                       # One alternative may match anything
+                return None
+            clause+=cond
+        return clause
+    if prd.ref is not None or prd.kind not in ("in","eq","btw"):  # regexp, *field, {substitution}
+        return None
+    if prd.kind=="btw":                                        # Lower bound only: tickets never come back into it
+        if prd.negate or prd.base!="now":
+            return None
+        return [(prd.key,"greater_than",(prd.delta if prd.minus else timedelta(0))+margin)]
+    val=prd.value
+    if "^" in val or "=" in val:                               # Would break the encoded query
+        return None
+    if not prd.negate:                                         # SNC compares case insensitively: superset is fine
+        if " " in val:                                         # May be a newline on the ticket
+            return None
+        if prd.kind=="in":
+            return [(prd.key,"contains",val)] if val else None
+        return [(prd.key,"equals",val)] if val else [(prd.key,"is_empty",None)]
+    if prd.kind=="eq" and not val:
+        return [(prd.key,"is_not_empty",None)]
+    if not icase or not val:                                   # Negation of a case insensitive compare drops too much
+        return None
+    return [(prd.key,"not_contains" if prd.kind=="in" else "not_equals",val),(prd.key,"is_empty",None)]  # != drops empties
+
+def CompileRule(rle,subargs,icase):
+    '''Compile a single rule entry of [appname].txt'''
+    find=[CompilePredicate(key,val,subargs,icase) for keypair in rle.get("find") or [] for key,val in keypair.items()]
+    return CompiledRule(rle["name"],tuple(find),rle.get("act") or [],rle)
+
+class AhoCorasick(object):
+    '''Aho-Corasick automaton, finds all of its (non empty) words in a text with a single pass over the text'''
+    __slots__=('goto','fail','out')
+    def __init__(self,words):
+        self.goto=[{}]
+        self.out=[frozenset()]
+        for word in words:                                     # Trie of the words
+            node=0
+            for ch in word:
+                nxt=self.goto[node].get(ch)
+                if nxt is None:
+                    nxt=len(self.goto)
+                    self.goto[node][ch]=nxt
+                    self.goto.append({})
+                    self.out.append(frozenset())
+                node=nxt
+            self.out[node]=self.out[node] | {word}
+        self.fail=[0]*len(self.goto)
+        queue=list(self.goto[0].values())                      # Failure links, breadth first
+        for node in queue:
+            for ch,nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail=self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail=self.fail[fail]
+                self.fail[nxt]=self.goto[fail].get(ch,0)
+                self.out[nxt]=self.out[nxt] | self.out[self.fail[nxt]]
+
+    def search(self,text):
+        '''Return the set of words found in text'''
+        goto,fail,out=self.goto,self.fail,self.out
+        node=0
+        found=set()
+        for ch in text:
+            while node and ch not in goto[node]:
+                node=fail[node]
+            node=goto[node].get(ch,0)
+            if out[node]:
+                found|=out[node]
+        return found
+
+class RuleSet(list):
+    '''Compiled rules of a rule file, with an index of the constant "contains" literals and regexps per field.
+       RuleSet.scan reads each indexed field of a ticket once and finds every literal it contains (one automaton
+       when a field has multi_pattern_min literals or more) and every regexp matching (one combined alternation).
+    '''
+    def __init__(self,rules,cfg,subargs):
+        list.__init__(self,rules)
+        self.fields=self.TicketFields(rules,cfg,subargs)
+        self.branches=self.Pushdown(rules,cfg)
+        lits={}
+        rxs={}
+        self.checks=[]                                         # Per rule: literals that must / must not be found
+        for rle in rules:
+            need=[]
+            for prd in rle.find:
+                if prd.kind=="in" and prd.ref is None:
+                    lits.setdefault(prd.key,set()).add(prd.value)
+                    need.append((prd.key,prd.value,prd.negate))
+                elif prd.kind=="re" and prd.regex is not None:
+                    rxs.setdefault(prd.key,{})[prd.value]=prd.regex
+            self.checks.append(tuple(need))
+        min_ac=int(cfg.get('multi_pattern_min',24))
+        self.lits={key: (frozenset(words),AhoCorasick(words) if len(words)>=min_ac else None) for key,words in lits.items()}
+        self.rxs={key: (frozenset(pats),self.CombineRegex(pats)) for key,pats in rxs.items()}
+
+    @staticmethod
+    def TicketFields(rules,cfg,subargs):
+        '''Ticket fields the rules and their actions refer to, or None if any of them may be needed'''
+        flds={'number','sys_id','sys_updated_on',cfg.get('snc_shw_descr','short_description')}
+        for rle in rules:
+            for prd in Predicates(rle.find):
+                flds.add(prd.key)
+                if prd.ref is not None:
+                    flds.add(prd.ref)
+                if prd.kind=="btw" and isinstance(prd.base,str) and prd.base[:1]=="*":
+                    flds.add(prd.base[1:])
+                if prd.kind=="dyn":
+                    if prd.value.lstrip("^~=@*")[:1]=="{":    # Substituted value may refer to any *field
+                        return None
+                    flds.update(TemplateRoots(prd.value))
+            for act1 in rle.act:
+                if not isinstance(act1,dict):
+                    continue
+                for act,prm in act1.items():
+                    if act=="run1" and cfg.get('run1_stdin',False):   # Whole ticket on stdin
+                        return None
+                    for val in (prm.values() if isinstance(prm,dict) else []):
+                        for txt in (val if isinstance(val,list) else [val]):
+                            roots=TemplateRoots("{}".format(txt))
+                            if act=="run1" and "tkt_json_file" in roots:   # Whole ticket passed on
+                                return None
+                            flds.update(roots)
+        return frozenset(fld for fld in flds if fld and not fld.isdigit() and fld not in subargs)
+
+    @staticmethod
+    def Pushdown(rules,cfg):
+        '''Per rule, the clauses ServiceNow can check for it; None if some rule has none (may match anything)'''
+        icase=bool(cfg.get('ignore_case',False))
+        margin=timedelta(hours=float(cfg.get('pushdown_time_margin_h',24)))  # Time zones of SNC user vs. me
+        branches=[]
+        for rle in rules:
+            if any(prd.kind=="err" for prd in rle.find):       # Never matches
+                continue
+            clauses=[clause for clause in (PushdownClause(prd,icase,margin) for prd in rle.find) if clause]
+            if not clauses:
+                return None
+            branches.append(clauses)
+        return branches or None
+
+    @staticmethod
+    def CombineRegex(pats):
+        '''Join regexps of a field to one alternation; return (regex, [(group_number, pattern)]) or None'''
+        alts=[]
+        groups=[]
+        gnum=1
+        for pat,rgx in pats.items():
+            if re.search(r'\\[1-9]|\(\?P=',pat):                 # Back references would break on renumbering
+                continue
+            try:
+                re.compile("({})".format(pat))
+            except re.error:                                    # e.g. global flags, kept as single regexp
+                continue
+            alts.append("({})".format(pat))
+            groups.append((gnum,pat))
+            gnum+=1+rgx.groups
+        if len(alts)<2:
+            return None
+        try:
+            return (re.compile("|".join(alts),list(pats.values())[0].flags),groups)
+        except re.error:
+            return None
+
+    def scan(self,tv):
+        '''Scan the indexed fields of a ticket once, store the results on the TicketView'''
+        for key,(words,auto) in self.lits.items():
+            try:
+                text=tv[key]
+            except KeyError:                                    # Left to rule testing to complain about
+                continue
+            if auto is None:
+                found={word for word in words if word in text}
+            else:
+                found=auto.search(text)
+                if "" in words:
+                    found.add("")
+            tv.lits[key]=(words,found)
+        for key,(pats,combined) in self.rxs.items():
+            if combined is None:
+                continue
+            try:
+                text=tv[key]
+            except KeyError:
+                continue
+            rgx,groups=combined
+            bygroup=dict(groups)
+            matched={bygroup[mtc.lastindex] for mtc in rgx.finditer(text) if mtc.lastindex in bygroup}
+            known=frozenset(pat for _,pat in groups)
+            tv.rxs[key]=(known,matched,not matched)           # No match at all: none of the regexps matches
+
+    def candidate(self,ix,tv):
+        '''False if rule #ix cannot match the scanned ticket because of its literals'''
+        for key,word,negate in self.checks[ix]:
+            scan=tv.lits.get(key)
+            if scan is not None and (word in scan[1])==negate:
+                return False
+        return True
+
+def CompiledRules(cfgfile,subargs,cfg,reloaded=None):
+    '''Return compiled rules of a rule file, compiling them again only when the file, cfg or the variables change'''
+    data=cfg_files.load(cfgfile,reloaded)
+    cached=rule_cache.get(cfgfile)
+    if cached and cached[0] is data and cached[1]==cfg and (cached[2] is subargs or cached[2]==subargs):
+        return cached[3]
+    icase=bool(cfg.get('ignore_case',False))
+    rules=RuleSet([CompileRule(rle,subargs,icase) for rle in data or []],cfg,subargs)
+    dbgmsg("Compiled {} rules of {}".format(len(rules),cfgfile),"185")
+    rule_cache[cfgfile]=(data,dict(cfg),subargs,rules)
+    return rules
+
+@lru_cache(maxsize=1)
+def Numpy():
+    '''numpy if installed, else None (batch_eval then works on lists)'''
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+class TicketBatch(object):
+    '''Tickets of a round as columns, to evaluate each rule over all of them at once (batch_eval). Values of
+       a field are normalized once and parsed as times once for the "@" finds. Each predicate gives a mask
+       over all tickets (numpy bool array if numpy is installed), the masks of a rule are ANDed. Rules with
+       finds needing substitution from the ticket, not compiled, or on fields missing from some ticket, have
+       no mask: they are tested ticket by ticket as usual. On first_match_only, the tickets matched by a rule
+       are left out of the columns the next rules are evaluated on.'''
+    def __init__(self,rules,tkts,cfg,stats=None):
+        self.np=Numpy()
+        self.icase=bool(cfg.get('ignore_case',False))
+        self.views=[TicketView(tkt,self.icase) for tkt in tkts]  # Normalized values shared with the actions
+        self.rows=list(range(len(tkts)))                       # Tickets the columns are of: not matched yet
+        self.done=[False]*len(tkts)                            # On first_match_only, matched by a rule
+        self.allcols={}                                        # field -> normalized values, None if missing somewhere
+        self.alltimes={}                                       # (field, raw) -> datetimes (None if not a time)
+        self.rebase(self.rows)
+        self.masks=[]                                          # Per rule, a bool per ticket or None
+        first=cfg.get('first_match_only',False)
+        for rle in rules:
+            cpu=time.thread_time()
+            mask=self.RuleMask(rle)
+            hits=None
+            if mask is not None:
+                hits=[False]*len(self.views)                   # Matched already by an earlier rule, not tested
+                for row,hit in zip(self.rows,mask):
+                    hits[row]=bool(hit)
+                if stats is not None:
+                    stat=stats.get(rle.name) or stats.setdefault(rle.name,[0,0,0.0])
+                    stat[0]+=len(self.rows)
+                    stat[2]+=time.thread_time()-cpu
+                if first:
+                    for row,hit in zip(self.rows,mask):
+                        if hit:
+                            self.done[row]=True
+                    rows=[row for row,hit in zip(self.rows,mask) if not hit]
+                    if len(rows)<len(self.rows)*0.75:          # Worth narrowing the columns
+                        self.rebase(rows)
+            self.masks.append(hits)
+
+    def rebase(self,rows):
+        '''Evaluate the next rules on these tickets only'''
+        self.rows=rows
+        self.cols={}                                           # Columns of the fields on rows
+        self.times={}
+        self.memo={}                                           # Predicate -> mask, rules share many
+
+    def hits(self,ix):
+        '''Per rule: True/False for ticket #ix, None if to be tested on the ticket'''
+        return [None if hits is None else hits[ix] for hits in self.masks]
+
+    def subset(self,col):
+        '''Values of a whole column on the rows'''
+        if col is None or len(self.rows)==len(self.views):
+            return col
+        return [col[row] for row in self.rows]
+
+    def column(self,key):
+        '''Normalized values of the field on the rows, or None if some ticket does not have it'''
+        if key not in self.cols:
+            if key not in self.allcols:
+                try:
+                    self.allcols[key]=[tv[key] for tv in self.views]
+                except KeyError:
+                    self.allcols[key]=None
+            self.cols[key]=self.subset(self.allcols[key])
+        return self.cols[key]
+
+    def timecol(self,key,raw=False):
+        '''Values of the field on the rows parsed as times (once), None where not a time'''
+        if (key,raw) not in self.times:
+            if (key,raw) not in self.alltimes:
+                if raw:                                        # *field of "@*field + 1h", as on the ticket
+                    vals=["{}".format(tv.tkt.get(key)) for tv in self.views]
+                else:
+                    self.column(key)
+                    vals=[val[:19] for val in self.allcols[key]] if self.allcols[key] is not None else None
+                col=None
+                if vals is not None:
+                    col=[]
+                    for val in vals:
+                        try:
+                            col.append(datetime.strptime(val,"%Y-%m-%d %H:%M:%S"))
+                        except ValueError:
+                            col.append(None)
+                self.alltimes[(key,raw)]=col
+            self.times[(key,raw)]=self.subset(self.alltimes[(key,raw)])
+        return self.times[(key,raw)]
+
+    def window(self,prd,alive):
+        '''Note the "@now" window flips of the predicate on the tickets it is tested on (alive)'''
+        for row,ts_2,live in zip(self.rows,self.timecol(prd.key),alive):
+            if live and ts_2 is not None and not self.done[row]:
+                self.views[row].window_at(ts_2,prd.delta,prd.minus)
+
+    def mask(self,vals):
+        '''Mask of a list of booleans'''
+        return self.np.array(vals,dtype=bool) if self.np is not None else vals
+
+    def both(self,mask1,mask2):
+        if self.np is not None:
+            return mask1&mask2
+        return [val1 and val2 for val1,val2 in zip(mask1,mask2)]
+
+    def either(self,mask1,mask2):
+        if self.np is not None:
+            return mask1|mask2
+        return [val1 or val2 for val1,val2 in zip(mask1,mask2)]
+
+    def invert(self,mask):
+        if self.np is not None:
+            return ~mask
+        return [not val for val in mask]
+
+    def PredicateMask(self,prd):
+        '''Mask of the tickets satisfying the predicate, or None if it cannot be evaluated over the batch'''
+        if prd in self.memo:
+            return self.memo[prd]
+        try:
+            mask=self.Evaluate(prd)
+        except Exception:                                      # Tested ticket by ticket, with the usual 391W
+            mask=None
+        if mask is not None and prd.negate:
+            mask=self.invert(mask)
+        self.memo[prd]=mask
+        return mask
+
+    def Evaluate(self,prd):
+        '''Mask of the predicate, negation not applied'''
+        if prd.kind=="any":
+            mask=None
+            for alt in prd.value:
+                alt_mask=self.PredicateMask(alt)
+                if alt_mask is None:
+                    return None
+                mask=alt_mask if mask is None else self.either(mask,alt_mask)
+            return mask
+        if prd.kind in ("dyn","err"):
+            return None
+        vals=self.column(prd.key)
+        if vals is None:
+            return None
+        if prd.kind=="btw":
+            if isinstance(prd.base,str) and prd.base!="now":  # from a field on the ticket
+                bases=self.timecol(prd.base[1:],raw=True)
+                if None in bases:                              # Not a time, error on the ticket
+                    return None
+                bounds=[(ts_1-prd.delta,ts_1) if prd.minus else (ts_1,ts_1+prd.delta) for ts_1 in bases]
+                return self.mask([str(lo)<=val<=str(hi) for (lo,hi),val in zip(bounds,vals)])
+            ts_1=datetime.now().replace(microsecond=0) if prd.base=="now" else prd.base
+            lo,hi=(ts_1-prd.delta,ts_1) if prd.minus else (ts_1,ts_1+prd.delta)
+            lo,hi=str(lo),str(hi)
+            if self.np is not None:
+                arr=self.np.array(vals,dtype=object)
+                return (arr>=lo)&(arr<=hi)
+            return [lo<=val<=hi for val in vals]
+        if prd.ref is not None:
+            refs=self.column(prd.ref)
+            if refs is None:
+                return None
+            if prd.kind=="re":
+                return self.mask([bool(ReCompile(ref,self.icase).search(val)) for ref,val in zip(refs,vals)])
+            if prd.kind=="eq":
+                return self.mask([ref==val for ref,val in zip(refs,vals)])
+            return self.mask([ref in val for ref,val in zip(refs,vals)])
+        if prd.kind=="re":
+            search=prd.regex.search
+            return self.mask([search(val) is not None for val in vals])
+        if prd.kind=="eq":
+            if self.np is not None:
+                return self.np.array(vals,dtype=object)==prd.value
+            return [prd.value==val for val in vals]
+        word=prd.value
+        return self.mask([word in val for val in vals])
+
+    def RuleMask(self,rle):
+        '''AND of the masks of the finds of a rule, None if the rule is to be tested ticket by ticket'''
+        masks=[self.PredicateMask(prd) for prd in rle.find]
+        if any(mask is None for mask in masks):
+            return None
+        alive=self.mask([True]*len(self.rows))
+        for prd,mask in zip(rle.find,masks):
+            for alt in Predicates((prd,)):
+                if alt.kind=="btw" and alt.base=="now":        # Tested on these tickets, as ticket by ticket
+                    self.window(alt,alive)
+            alive=self.both(alive,mask)
+            if not (alive.any() if self.np is not None else any(alive)):
+                break
+        return alive
+############################################################################################
 def SncConnection(snc,user,pwd):
-    '''Establish a connection to ServiceNow'''
+    '''Establish a connection to ServiceNow. All robots and workers share its pool of http_pool_size keep-alive
+       connections; GETs are retried on 429/5xx (after Retry-After) and connection errors by urllib3 (http_retries).'''
+    ImportSnc()
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     s=requests.Session()
+    retry=dict(total=int(cfg.get('http_retries',3)),backoff_factor=float(cfg.get('http_backoff_sec',0.5)),
+        status_forcelist=(429,500,502,503,504),respect_retry_after_header=True,raise_on_status=False)
+    try:
+        retry=Retry(allowed_methods=frozenset(['GET']),**retry)    # Updates are retried by UpdatePipeline
+    except TypeError:                         # urllib3 before 1.26
+        retry=Retry(method_whitelist=frozenset(['GET']),**retry)
+    adapter=HTTPAdapter(pool_connections=4,pool_maxsize=int(cfg.get('http_pool_size',32)),max_retries=retry)
+    s.mount("https://",adapter)
+    s.mount("http://",adapter)
+    s.headers.update({'Accept-Encoding': 'gzip, deflate'})
     prx=cfg.get('proxy','')
     if prx:
         dbgmsg("Using proxy: {}".format(prx),"183")
         s.proxies.update({'https': prx})
     s.auth=requests.auth.HTTPBasicAuth(user,pwd)
+    if cfg.get('snc_host',''):                # Full host name instead of instance, e.g. a test server
+        return pysnow.Client(host=cfg['snc_host'],session=s,use_ssl=cfg.get('use_ssl',True))
     return pysnow.Client(instance=snc,session=s)
 
 def SncResource(sncclient,snctable):
     return sncclient.resource(api_path='/table/{}'.format(snctable))
 
-def ReadQualifyingTickets(sco,cfg):
+def ReadQualifyingTickets(sco,cfg,since=None,sys_ids=(),fields=None):
     '''Read from ServiceNow, return the result or raise an exception.'''
-    qb=pysnow.QueryBuilder().field('active').equals("1")
-    if cfg.get('snc_state_ignore',"6"):
-        qb.AND().field('state').not_equals(cfg.get('snc_state_ignore',"6"))
-    if cfg.get('snc_assign_group',""):
-        qb.AND().field('assignment_group').equals(cfg.get('snc_assign_group',""))
-    qb.AND().field("sysparm_limit").equals("333")
-    dbgmsg("Q: {}".format(qb),"184")
-    return sco.get(query=qb).all()
-
-def TicketMatchesRule(num,tkt,rulename,match,subargs):
-    '''Compare the values of ticket to single configuration entry. Return True if the ticket matches the criteria.'''
-    try:
-        runargs=dict(tkt)            # Build a dict of all possible variables to substitute
-        runargs.update(subargs)      # (ticket, ENV and *vars*txt)
-        for keypair in match:
-            return_reverse=False
-            for key,val in keypair.items():
-                val1="{}".format(val)
-                val2="{}".format(tkt[key])
-                try:                                           # Substitute variables
-                    val1=val1.format(**runargs)
-                except Exception:
-                    pass
-                cmtcc=""
-                if bool(len(val1)) and val1[0] == '^':         # e.g. "^Foo"
-                    return_reverse=True
-                    cmtcc=val1[:1]
-                    val1=val1[1:]
-                use_regex=False
-                use_equals=False
-                use_btw=False
-                if bool(len(val1)) and val1[0] == "~":         # e.g. "~Foo|Bar" (regexp)
-                    use_regex=True
-                    val1=val1[1:]
-                elif bool(len(val1)) and val1[0] == "=":       # e.g. "=Foo" (exact value)
-                    use_equals=True
-                    val1=val1[1:]
-                elif bool(len(val1)) and val1[0] == "@":       # e.g. "@now - 24h" (between time)
-                    use_btw=True
-                    btw_attrs=val1[1:].split(" ")
-                    base=btw_attrs[0]                          # base to be str YYYY-MM-DD HH:MM:SS
-                    if base=="now":
-                        base=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    elif bool(len(base)) and base[0] == "*":
-                        base="{}".format(tkt[val1[1:]])        # from a field on the ticket
-                    ts_1=datetime.strptime(base, "%Y-%m-%d %H:%M:%S")
-                    if btw_attrs[1] == "-":
-                        ts_2=ts_1
-                        ts_1=ts_2-parse_time(btw_attrs[2])
-                    else:
-                        ts_2=ts_1+parse_time(btw_attrs[2])
-                    val1=str(ts_1)
-                    val1b=str(ts_2)
-                if bool(len(val1)) and val1[0] == '*':         # e.g. "*sys_created_by", "^*sys_updated_at"
-                    val1="{}".format(tkt[val1[1:]])
-                else:
-                    val2="{}".format(tkt[key])
-                if cfg.get('ignore_case',False):               # Force lower case to compare
-                    val1=val1.lower()
-                    val2=val2.lower()
-                val1=val1.replace('\n',' ').replace('\r','')   # Replace newlines with blanks before comparing strings
-                val2=val2.replace('\n',' ').replace('\r','')
-                cstr="{}'{}' {}~ '{}'".format(key[0:35],val2[0:35],cmtcc,val1[0:35])
-                if use_regex:
-                    matched=bool(re.search(val1,val2)) ^ return_reverse
-                elif use_equals:
-                    matched=bool(val1==val2) ^ return_reverse
-                    cstr="{}'{}' {}= '{}'".format(key[0:35],val2[0:35],cmtcc,val1[0:35])
-                elif use_btw:
-                    matched=bool(val1<=val2 and val1b>=val2) ^ return_reverse
-                    cstr="{} {}[{} ... {}]".format(val2,cmtcc,val1,val1b)
+    return list(IterQualifyingTickets(sco,cfg,since,sys_ids,fields))
+
+def TicketQuery(cfg,since=None,sys_ids=(),branches=None):
+    '''Build the query for qualifying tickets. With branches (RuleSet.branches), the tickets matching
+       the conditions of any of them: base conditions + clauses of a branch, joined with NQ (new query).'''
+    qb=pysnow.QueryBuilder()
+    now=datetime.now()
+    for ix,branch in enumerate(branches or [[]]):
+        if ix:
+            qb.NQ()
+        qb.field('active').equals("1")
+        if cfg.get('snc_state_ignore',"6"):
+            qb.AND().field('state').not_equals(cfg.get('snc_state_ignore',"6"))
+        if cfg.get('snc_assign_group',""):
+            qb.AND().field('assignment_group').equals(cfg.get('snc_assign_group',""))
+        if since is not None:
+            qb.AND().field('sys_updated_on').greater_than(since)
+            if sys_ids:
+                qb.OR().field('sys_id').equals(list(sys_ids))
+        elif sys_ids:                                        # These tickets only
+            qb.AND().field('sys_id').equals(list(sys_ids))
+        for clause in branch:
+            for cx,(fld,oper,arg) in enumerate(clause):      # ^OR binds to the condition before it
+                (qb.OR() if cx else qb.AND()).field(fld)
+                if arg is None:
+                    getattr(qb,oper)()
                 else:
-                    matched=bool(val1 in val2) ^ return_reverse
-                dbgmsg("? {}: {}".format(matched,cstr),"382")
-                if not matched:                                # Break after first mismatch
-                   return False
+                    getattr(qb,oper)(now-arg if isinstance(arg,timedelta) else arg)
+    qb.AND().field('sys_id').order_ascending()               # Stable order to page through
+    return qb
+
+def KeysetQuery(qb,after):
+    '''Encoded query of TicketQuery for the tickets past sys_id after: sys_id>after on every branch (^NQ).
+       Pages by key, not offset, are not shifted by tickets our actions take out of the query meanwhile.'''
+    order="^ORDERBYsys_id"
+    query=str(qb)
+    if query.endswith(order):
+        query=query[:-len(order)]
+    return "^NQ".join("{}^sys_id>{}".format(part,after) for part in query.split("^NQ"))+order
+
+def IterQualifyingTickets(sco,cfg,since=None,sys_ids=(),fields=None,branches=None):
+    '''Read from ServiceNow page by page (snc_page_size), yielding the tickets as the pages arrive.
+       With since, only tickets updated after it (or having one of sys_ids) are read; without, only sys_ids if given.
+       With fields, only those fields of the tickets are read.
+       With branches, only tickets that may match a rule are read (see TicketQuery).'''
+    qb=TicketQuery(cfg,since,sys_ids,branches)
+    if branches and len(str(qb))>int(cfg.get('pushdown_max_len',4000)):   # Keep the URL in bounds
+        dbgmsg("Query too long to push rules down, {} chars".format(len(str(qb))),"187")
+        qb=TicketQuery(cfg,since,sys_ids)
+    fields=sorted(set(fields)|{'sys_id'}) if fields else []  # sys_id: key of the next page
+    dbgmsg("Q: {} F: {}".format(qb,",".join(fields) or "*"),"184")
+    page=int(cfg.get('snc_page_size',333))
+    query=qb
+    rbt=getattr(current,'robot',None)
+    while True:
+        clk=time.perf_counter()
+        try:
+            tkts=sco.get(query=query,limit=page,fields=fields).all()
+        except Exception:
+            if rbt is not None:
+                rbt.count('api_get_errors')
+            raise
+        finally:
+            if rbt is not None:
+                rbt.count('api_get')
+                rbt.hist['fetch'].observe(time.perf_counter()-clk)
+        for tkt in tkts:
+            yield tkt
+        if len(tkts)<page:
+            break
+        query=KeysetQuery(qb,tkts[-1]['sys_id'])
+
+class TicketCache(object):
+    '''State of incremental polling for one robot: the sys_updated_on high-water mark and the tickets
+       evaluated, with the time one of their "@now ..." windows may flip (then they are evaluated again)'''
+    def __init__(self):
+        self.rules=None                                        # RuleSet the results were got with
+        self.watermark=""                                      # Highest sys_updated_on seen
+        self.seen={}                                           # sys_id: (sys_updated_on, recheck)
+        self.full_at=0                                         # time.time() of the last full read
+
+    def due(self):
+        '''sys_ids of tickets with a time window flipped since evaluated'''
+        now=datetime.now()
+        return [sys_id for sys_id,(_,recheck) in self.seen.items() if recheck is not None and recheck<=now]
+
+    def changed(self,tkt):
+        '''True if the ticket needs to be evaluated: new, updated or a time window flipped'''
+        old=self.seen.get(tkt.get('sys_id'))
+        return old is None or old[0]!=tkt.get('sys_updated_on') or (old[1] is not None and old[1]<=datetime.now())
+
+    def store(self,tkt,recheck):
+        '''Remember the ticket as evaluated'''
+        self.seen[tkt.get('sys_id')]=(tkt.get('sys_updated_on'),recheck)
+
+    def forget(self,sys_id):
+        '''Acting on the ticket failed: read and evaluate it again next round, though unchanged'''
+        self.seen[sys_id]=(None,datetime.min)
+
+def Pushdown(rules,cfg):
+    '''Rule conditions to check on ServiceNow already, if pushdown is on (not on --record, other rules may be replayed)'''
+    return rules.branches if cfg.get('pushdown',False) and snapshot is None else None
+
+def FieldsToRead(rules):
+    '''Fields of the tickets to read, all on --record'''
+    return rules.fields if snapshot is None else None
+
+def ReadChangedTickets(sco,cfg,cache,rules,tkts=None):
+    '''Incremental read: tickets updated since the high-water mark, and the ones due to a time window recheck.
+       Everything is read on the first round, after the rules change and every full_sync_sec.
+       Yield the tickets to be evaluated; the cache is brought up to date once all have been read.
+       tkts: all qualifying tickets, read already (used on a full read)'''
+    full=cache.rules is not rules or not cache.watermark or time.time()-cache.full_at>=float(cfg.get('full_sync_sec',3600))
+    since=None
+    due=[]
+    if full:
+        if cache.rules is not rules:                           # Earlier results do not tell anything anymore
+            cache.seen={}
+    else:
+        due=cache.due()
+        since=datetime.strptime(cache.watermark[:19],"%Y-%m-%d %H:%M:%S")-timedelta(seconds=float(cfg.get('incremental_overlap_sec',60)),
+            hours=-float(cfg.get('snc_utc_offset_h',0)))       # Mark in UTC, the query in the time zone of the SNC user
+    ids=set()
+    mark=cache.watermark
+    if tkts is None or not full:
+        tkts=IterQualifyingTickets(sco,cfg,since,due,FieldsToRead(rules),Pushdown(rules,cfg))
+    for tkt in tkts:
+        ids.add(tkt.get('sys_id'))
+        if "{}".format(tkt.get('sys_updated_on') or "")>mark:
+            mark="{}".format(tkt['sys_updated_on'])
+        if cache.changed(tkt):
+            yield tkt
+    for sys_id in [sys_id for sys_id in (list(cache.seen) if full else due) if sys_id not in ids]:
+        cache.seen.pop(sys_id,None)                            # No longer qualifying
+    cache.watermark=mark
+    if full:
+        cache.rules=rules
+        cache.full_at=time.time()
+    dbgmsg("Incremental: {}, {} read, {} known, mark {}".format("full" if full else "changed",len(ids),len(cache.seen),cache.watermark),"186")
+
+def TicketMatchesRule(num,tv,rle,runargs):
+    '''Compare the values of ticket (TicketView) to a single compiled rule. Return True if the ticket matches the criteria.'''
+    try:
+        for prd in rle.find:
+            if not prd.test(tv,runargs):                       # Break after first mismatch
+                return False
         return True                                            # All matched
     except Exception as e:
         prtmsg("#{} ?!? {}".format(num,e),"391","W")
         print(e)
         return False                                           # In case of any error, treat as no match
 
-def UpdateTicket(sco,num,dta):
-    '''Update a ticket with specfied values (unless --simulation)'''
+class Histogram(object):
+    '''Latencies in seconds, counted in the buckets Prometheus uses by default'''
+    buckets=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+    def __init__(self):
+        self.counts=[0]*(len(self.buckets)+1)                  # the last one for +Inf
+        self.sum=0.0
+        self.lock=threading.Lock()
+
+    def observe(self,sec):
+        ix=bisect.bisect_left(self.buckets,sec)
+        with self.lock:
+            self.counts[ix]+=1
+            self.sum+=sec
+
+    def quantile(self,q):
+        '''Upper bound of the bucket having the q quantile, None if nothing observed'''
+        total=sum(self.counts)
+        cum=0
+        for bound,cnt in zip(self.buckets+(float('inf'),),self.counts):
+            cum+=cnt
+            if total and cum>=q*total:
+                return bound
+        return None
+
+    def prometheus(self,name,labels):
+        '''Lines of the histogram in Prometheus text format'''
+        with self.lock:
+            counts=list(self.counts)
+            total=self.sum
+        lines=[]
+        cum=0
+        for bound,cnt in zip(self.buckets+(float('inf'),),counts):
+            cum+=cnt
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name,labels,"+Inf" if bound==float('inf') else bound,cum))
+        lines.append('{}_sum{{{}}} {}'.format(name,labels,total))
+        lines.append('{}_count{{{}}} {}'.format(name,labels,cum))
+        return lines
+
+class TokenBucket(object):
+    '''Rate limiter: rate tokens per second, at most burst of them saved up'''
+    def __init__(self,rate,burst):
+        self.rate=float(rate)
+        self.burst=max(1.0,float(burst))
+        self.tokens=self.burst
+        self.stamp=time.monotonic()
+        self.lock=threading.Lock()
+
+    def take(self):
+        '''Wait until a token is available, and take it'''
+        while True:
+            with self.lock:
+                now=time.monotonic()
+                self.tokens=min(self.burst,self.tokens+(now-self.stamp)*self.rate)
+                self.stamp=now
+                if self.tokens>=1:
+                    self.tokens-=1
+                    return
+                wait=(1-self.tokens)/self.rate
+            time.sleep(wait)
+
+class UpdatePipeline(object):
+    '''Ticket updates as PATCH by sys_id on a bounded pool of workers (update_concurrency). Shared by all robots,
+       so that the token bucket (update_rate per second) keeps all of us under the API quota of the instance.
+       429 and 5xx responses and connection errors are retried with exponential backoff (update_retries).
+       Updates adding a work note or comment are not idempotent: they are retried only if SNC surely did
+       not take them, i.e. on 429 and on failing to connect.'''
+    def __init__(self,scli,cfg):
+        self.scli=scli
+        self.pool=ThreadPoolExecutor(max_workers=int(cfg.get('update_concurrency',8)),thread_name_prefix="update")
+        self.bucket=TokenBucket(cfg.get('update_rate',10),cfg.get('update_burst',cfg.get('update_rate',10)))
+        self.retries=int(cfg.get('update_retries',4))
+        self.backoff=float(cfg.get('update_backoff_sec',1))
+
+    def submit(self,rbt,num,tkt,dta,rule=None):
+        '''Queue an update of a ticket, return its Future'''
+        return self.pool.submit(self.patch,rbt,num,tkt,dta,rule)
+
+    def patch(self,rbt,num,tkt,dta,rule=None):
+        '''Update a single ticket (on a worker thread), log the result'''
+        current.robot=rbt
+        started=time.monotonic()
+        try:
+            url="{}/api/now/table/{}/{}".format(self.scli.base_url,rbt.cfg.get('snc_table','incident'),tkt['sys_id'])
+            append=any(fld in dta for fld in ('work_notes','comments',rbt.cfg.get('snc_comment_field','work_notes')))
+            for attempt in range(self.retries+1):
+                self.bucket.take()
+                try:
+                    rsp=self.scli.session.patch(url,json=dta,headers={'Accept': 'application/json'})
+                    if rsp.status_code!=429 and (rsp.status_code<500 or append):   # 5xx: the note may be added already
+                        break
+                    try:
+                        delay=float(rsp.headers.get('Retry-After') or 0)
+                    except ValueError:                          # HTTP date, use own backoff
+                        delay=0
+                except ConnectionError as e:
+                    rsp=e
+                    delay=0
+                    if append and not Unsent(e):
+                        break
+                if attempt<self.retries:
+                    time.sleep(max(delay,self.backoff*2**attempt*random.uniform(0.5,1.5)))
+            failed=isinstance(rsp,Exception) or rsp.status_code>=300
+            rbt.count('api_patch',attempt+1)
+            result=rsp
+            if failed:
+                rbt.count('api_patch_errors')
+                rbt.fail(tkt['sys_id'],rule)
+            else:
+                result=rsp.json().get('result',{})
+                if rbt.journal is not None:
+                    rbt.journal.updated(rbt.name,tkt['sys_id'],result.get('sys_updated_on'))
+            rbt.hist['act'].observe(time.monotonic()-started)
+            prtmsg("#{} -> update: '{}' -> {}".format(num,dta,result),"402","E" if failed else "I",num,rule,"update",time.monotonic()-started)
+            return rsp
+        except Exception as e:
+            prtmsg("#{} -> update: '{}' -> {}".format(num,dta,e),"402","E",num,rule,"update",time.monotonic()-started)
+            rbt.fail(tkt['sys_id'],rule)
+        finally:
+            current.robot=None
+
+def Unsent(e):
+    '''True if the request of ConnectionError e did not reach SNC (connecting failed), so it can be sent again'''
+    from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+    reason=getattr(e.args[0],'reason',None) if e.args else None
+    return isinstance(e,requests.exceptions.ConnectTimeout) or isinstance(reason,(NewConnectionError,ConnectTimeoutError))
+
+def UpdateTicket(sco,num,dta,tkt=None,rule=None):
+    '''Update a ticket with specfied values (unless --simulation).
+       Having sys_id of the ticket, the update is queued for the UpdatePipeline of the robot, which
+       logs the result later; then None is returned.'''
     if simulation:
         return "[simulation] {}".format(dta)
+    rbt=getattr(current,'robot',None)
+    if rbt is not None and rbt.updates is not None and tkt and tkt.get('sys_id'):
+        rbt.pending.append(rbt.updates.submit(rbt,num,tkt,dta,rule))
+        return None
+    if rbt is not None:
+        rbt.count('api_update')
     return sco.update(query={'number': num},payload=dta)
 
 def ActionsOnTicket(num,rname,tkt,acts,subargs,sco,cfg):
     '''Perform the wished actons on a matching ticket.'''
     for act1 in acts:
-        runargs=dict(tkt)            # Build a dict of all possible variables to substitute
-        runargs.update(subargs)      # (ticket, ENV and *vars*txt)
+        runargs=ChainMap({},subargs,tkt)    # All possible variables to substitute (ENV and *vars*txt over ticket)
         dbgmsg("> {}".format(act1),"481")
         prm=""
         if isinstance(act1,dict):
@@ -314,134 +1538,917 @@ def ActionsOnTicket(num,rname,tkt,acts,subargs,sco,cfg):
         if prm is None:
             prm=""
         if act1 == "nop":
-            prtmsg("#{} -> {}".format(num,act1),"401")
+            prtmsg("#{} -> {}".format(num,act1),"401","I",num,rname,act1)
         elif act1 == "update":
+            prm=dict(prm)                             # My own copy, the compiled rule is shared by all tickets
             fld_comment=cfg.get('snc_comment_field','work_notes')    # comments / work notes
             if fld_comment not in prm:                # Force adding a comment in all cases; default already pretty good
-                prm[fld_comment]="{}402I {} -> {}".format(mpfx,robotname,rname)
+                rbtname,rbtpfx=CurrentRobot()
+                prm[fld_comment]="{}402I {} -> {}".format(rbtpfx,rbtname,rname)
             for key,val in prm.items():    # Substitute variables, e.g. {number}
                 try:
-                    prm[key]=SelectSingleValue(val,rname,key,cfg).format(**runargs)      # Pick value & substitute value
+                    prm[key]=SelectSingleValue(val,rname,key,cfg).format_map(runargs)    # Pick value & substitute value
                     if prm[key][0]=='[' and prm[key][-1]==']':                           # Got a list? Pick single value
                         prm[key]=str(SelectSingleValue(eval(prm[key]),rname,key,cfg))
                 except KeyError:
                     pass
-            rsp=UpdateTicket(sco,num,prm)
-            prtmsg("#{} -> {}: '{}' -> {}".format(num,act1,prm,rsp),"402")
+            started=time.monotonic()
+            rsp=UpdateTicket(sco,num,prm,tkt,rname)
+            if rsp is not None:                       # else logged once done
+                ObserveAct(started)
+                prtmsg("#{} -> {}: '{}' -> {}".format(num,act1,prm,rsp),"402","I",num,rname,act1,time.monotonic()-started)
         elif act1 == "run1":
-            tfd, tfile = tempfile.mkstemp()
-            try:
-                with os.fdopen(tfd,'w',encoding='utf-8') as tmp:       # Write ticket details to a temp file
-                    tmp.write(str(eval(json.dumps(tkt))))              # Ugly fix of unicode strings
+            tfile=""
+            if "tkt_json_file" in TemplateRoots(prm['cmd']):  # Ticket details to a file in the spool dir
+                tfile=Run1SpoolFile(num,cfg)
                 runargs['tkt_json_file']=tfile
-                run1cmd=prm['cmd'].format(**runargs)
-                if simulation:
-                   prtmsg("#{} -> [simulation]: '{}'".format(num,run1cmd),"403")
-                else:
-                   subcmd=subprocess.Popen(run1cmd,stdout=subprocess.PIPE,shell=True)
-                   (subcmd_out,subcmd_err)=subcmd.communicate(timeout=int(cfg.get('ext_cmd_timeout',30)))
-                   subcmd_status=subcmd.wait()
-                   prtmsg("#{} -> {}: RC={} '{}'".format(num,act1,subcmd_status,run1cmd),"403")
-                   CmdResultOutput(num,subcmd_err,"404")
-                   CmdResultOutput(num,subcmd_out,"405")
-            finally:
-                os.remove(tfile)
+            run1cmd=prm['cmd'].format_map(runargs)
+            rbt=getattr(current,'robot',None)
+            if simulation:
+               prtmsg("#{} -> [simulation]: '{}'".format(num,run1cmd),"403","I",num,rname,act1)
+            elif rbt is not None:                     # Logged once done, the next tickets do not wait
+               rbt.run_later(Run1,num,run1cmd,tkt,tfile,cfg,rname)
+            else:
+               Run1(num,run1cmd,tkt,tfile,cfg,rname)
         else:
-            prtmsg("#{} ?? {} {}".format(num,act1,prm),"491","E")
+            prtmsg("#{} ?? {} {}".format(num,act1,prm),"491","E",num,rname,act1)
     return True
 
-def ProcessSingleTicket(num,tkt,rules,subargs,cfg,sco):
-    '''For given ticket, find matching rule(s) and execute actions from them. Return true if something was done.'''
+def ObserveAct(started):
+    '''Time of an action since started (time.monotonic) to the act histogram of the robot'''
+    rbt=getattr(current,'robot',None)
+    if rbt is not None:
+        rbt.hist['act'].observe(time.monotonic()-started)
+
+def Run1SpoolFile(num,cfg):
+    '''Name of a new file for ticket details in the spool dir of run1 (run1_spool_dir)'''
+    spool=cfg.get('run1_spool_dir','') or os.path.join(tempfile.gettempdir(),"TicketSupervisor-spool")
+    os.makedirs(spool,exist_ok=True)
+    return os.path.join(spool,"{}-{}-{}.json".format(num,os.getpid(),next(spool_seq)))
+
+def Run1(num,run1cmd,tkt,tfile,cfg,rule=None):
+    '''Run the external command of a run1 action, stop it after ext_cmd_timeout, log RC and output.
+       The ticket details are written to tfile (if any) and, with run1_stdin, given on stdin as JSON.'''
+    started=time.monotonic()
+    try:
+        if tfile:
+            with open(tfile,'w',encoding='utf-8') as tmp:
+                tmp.write(str(eval(json.dumps(tkt))))              # Ugly fix of unicode strings
+        data=json.dumps(tkt).encode('utf-8') if cfg.get('run1_stdin',False) else None
+        group={'start_new_session': True} if os.name=='posix' else {}  # To stop the children as well
+        subcmd=subprocess.Popen(run1cmd,stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,**group)
+        timeout=int(cfg.get('ext_cmd_timeout',30))
+        try:
+            (subcmd_out,subcmd_err)=subcmd.communicate(input=data,timeout=timeout)
+            prtmsg("#{} -> run1: RC={} '{}'".format(num,subcmd.returncode,run1cmd),"403","I",num,rule,"run1",time.monotonic()-started)
+        except subprocess.TimeoutExpired:
+            if os.name=='posix':
+                os.killpg(subcmd.pid,signal.SIGKILL)
+            else:
+                subprocess.call(["taskkill","/F","/T","/PID",str(subcmd.pid)],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+            (subcmd_out,subcmd_err)=subcmd.communicate()
+            prtmsg("#{} -> run1: stopped after {} sec, RC={} '{}'".format(num,timeout,subcmd.returncode,run1cmd),"403","W",num,rule,"run1",time.monotonic()-started)
+        ObserveAct(started)
+        CmdResultOutput(num,subcmd_err,"404")
+        CmdResultOutput(num,subcmd_out,"405")
+    except Exception as e:
+        prtmsg("#{} ?? run1 {} {}".format(num,run1cmd,e),"491","E",num,rule,"run1")
+    finally:
+        if tfile and os.path.isfile(tfile):
+            os.remove(tfile)
+
+def ProcessSingleTicket(num,tkt,rules,subargs,cfg,sco,tv=None,hits=None):
+    '''For given ticket, find matching rule(s) and execute actions from them. Return true if something was done.
+       hits: per rule, whether the ticket matches as found by TicketBatch (None: to be tested here)'''
     actions=False
-    for rle in copy.deepcopy(rules):   # Use my own copy of rules, as they may have varying variable substitutions
-        rname=rle["name"]
-        dbgmsg("#{} {}:".format(num,rname),"282")
-        if TicketMatchesRule(num,tkt,rname,rle["find"],subargs):
-            prtmsg("#{} == {} - {}".format(num,rname,tkt[cfg.get('snc_shw_descr','short_description')][0:127]),"202")
-            actions=ActionsOnTicket(num,rname,tkt,rle["act"],subargs,sco,cfg)
+    journaled=False                                            # A rule matched, but was acted on already
+    claimed=False                                              # Claimed from the cluster for this round
+    if tv is None:
+        tv=TicketView(tkt,bool(cfg.get('ignore_case',False))) # Field values normalized once for all rules
+    runargs=ChainMap(subargs,tkt)                             # Variables for substitutions left to run time
+    rbt=getattr(current,'robot',None)
+    stats=rbt.rule_stats if rbt is not None else {}           # rule -> [evaluations, matches, CPU seconds]
+    if hits is None:
+        rules.scan(tv)                                         # Find all literals & regexps of all rules at once
+    for ix,rle in enumerate(rules):                            # Compiled rules are never modified, no copy needed
+        rname=rle.name
+        matched=hits[ix] if hits is not None else None
+        if matched is None:
+            if not debug and not rules.candidate(ix,tv):       # On debug, show all predicates tested
+                continue
+            if debug:
+                dbgmsg("#{} {}:".format(num,rname),"282")
+            if rule_cpu:
+                cpu=time.thread_time()
+            matched=TicketMatchesRule(num,tv,rle,runargs)
+            stat=stats.get(rname) or stats.setdefault(rname,[0,0,0.0])
+            stat[0]+=1
+            if rule_cpu:                                       # Shown on metrics and stats dumps only
+                stat[2]+=time.thread_time()-cpu
+        if matched:
+            stat=stats.get(rname) or stats.setdefault(rname,[0,0,0.0])
+            stat[1]+=1
+            if rbt is not None and rbt.journal is not None:
+                if rbt.journal.done(rbt.name,tkt,rname):       # Acted on already, the ticket has not changed since
+                    rbt.counters['journaled']+=1
+                    journaled=True
+                    dbgmsg("#{} == {} - done already".format(num,rname),"283")
+                    if cfg.get('first_match_only',False):
+                        return actions
+                    continue
+            if rbt is not None and rbt.cluster is not None and not claimed:
+                if not rbt.cluster.claim(tkt['sys_id']):       # Another member is on it, the members just changed
+                    rbt.counters['claim_lost']+=1
+                    dbgmsg("#{} == {} - claimed by another member".format(num,rname),"284")
+                    return actions
+                claimed=True
+            prtmsg("#{} == {} - {}".format(num,rname,tkt[cfg.get('snc_shw_descr','short_description')][0:127]),"202","I",num,rname)
+            clk=time.perf_counter()
+            at=time.time()
+            actions=ActionsOnTicket(num,rname,tkt,rle.act,subargs,sco,cfg)
+            if rbt is not None:
+                rbt.timing['act_sync']+=time.perf_counter()-clk
+                if rbt.journal is not None and not simulation:  # Journaled once the queued actions are done too
+                    rbt.acted.append((tkt,rname,at))
             if cfg.get('first_match_only',False):
                 return actions
-    if not actions and not quiet:
+    if not actions and not journaled and not quiet:
         prtmsg("#{} NA - {}".format(num,tkt[cfg.get('snc_shw_descr','short_description')][0:127]),"201")
     return actions
 
-def LoopRobotsOnce(scli):
-    '''Process open tickets once for all robots.'''
-    global robotname
-    for robotname in appname:
-        cfg=EffectiveCfgForOneRobot(robotname)
-        global mpfx
-        mpfx=cfg.get('msg_prefix',mpfx0)
-        sco=SncResource(scli,cfg.get('snc_table','incident'))
-        tkts=ReadQualifyingTickets(sco,cfg)
-        if tkts:
+class RobotContext(object):
+    '''Everything one robot works with: cfg, message prefix, SNC resource, incremental cache and counters.
+       Robots keep no module level state, so each of them can run on a thread of its own.'''
+    def __init__(self,name,scli,updates=None,journal=None,cluster=None):
+        self.name=name
+        self.scli=scli
+        self.cfg={}
+        self.cache=None
+        self.configure(whole_cfg)
+        self.updates=updates                                   # UpdatePipeline, shared by all robots
+        self.journal=journal                                   # ActionJournal, shared by all robots
+        self.cluster=cluster                                   # Cluster membership, shared by all robots
+        self.cluster_gen=cluster.generation if cluster is not None else 0
+        self.run1=ThreadPoolExecutor(max_workers=int(self.cfg.get('run1_concurrency',4)),thread_name_prefix="run1-{}".format(name))
+        self.pending=[]                                        # Futures of updates and run1s queued this round
+        self.counters=Counter()                                # loops, tickets, matched, errors
+        self.timing=Counter()                                  # Seconds of the latest round: fetch, match, act(_sync)
+        self.hist={key: Histogram() for key in ('fetch','match','act')}  # Seconds per page, ticket, action
+        self.rule_stats={}                                     # rule -> [evaluations, matches, CPU seconds]
+        self.acted=[]                                          # (ticket, rule, time.time()) acted on this round
+        self.failed=set()                                      # (sys_id, rule) of the updates failed this round
+        self.stat_lock=threading.Lock()                        # counters from the update & run1 workers
+        self.error=None                                        # Set if the robot gave up
+        self.events=EventQueue() if self.cfg.get('webhook_port',0) else None  # Tickets notified by webhook
+        self.prefetched=None                                   # (rules, tickets) read at start, for the 1st round
+
+    def configure(self,whole):
+        '''Take the cfg of the robot from whole TicketSupervisor.cfg'''
+        cfg=EffectiveCfgForOneRobot(self.name,whole)
+        if cfg.get('snc_table','incident')!=self.cfg.get('snc_table') or cfg.get('incremental',False)!=self.cfg.get('incremental',False):
+            self.sco=SncResource(self.scli,cfg.get('snc_table','incident'))
+            self.cache=TicketCache() if cfg.get('incremental',False) else None
+        self.whole=whole
+        self.mpfx=cfg.get('msg_prefix',mpfx0)
+        self.cfg=cfg
+
+    def refresh(self,reloaded):
+        '''Between rounds: take a changed TicketSupervisor.cfg into use (global, connection and pool settings need a restart)'''
+        global whole_cfg
+        if os.path.isfile(cfgfn):
+            whole=cfg_files.load(cfgfn,reloaded)
+            if whole and whole is not self.whole:
+                whole_cfg=whole
+                self.configure(whole)
+
+    def idle(self,sec):
+        '''Wait sec seconds between rounds; process the tickets notified meanwhile (webhook)'''
+        if self.events is None:
+            time.sleep(sec)
+            return
+        until=time.monotonic()+sec
+        while True:
+            sys_ids=self.events.take(until)
+            if not sys_ids:
+                return
             try:
-                rules=ReadCfg(GetCfgFileName(robotname))
-                subargs=GetSubArgs(robotname,cfg)
-                dbgmsg("{} n={}, {}".format(robotname,len(tkts),rules),"281")
-                for tkt in tkts:
-                    num=tkt["number"]
-                    try:
-                        ProcessSingleTicket(num,tkt,rules,subargs,cfg,sco)
-                    except Exception as e:
-                        prtmsg("#{} - unsuccessful, {} trying to continue, DG: {}".format(num,robotname,str(e)),"192","E")
+                RunRobotOnce(self,sys_ids)
+            except ConnectionError:
+                for sys_id in sys_ids:                         # Processed after the retry of RobotLoop
+                    self.events.put(sys_id,0)
+                raise
+
+    def count(self,key,inc=1):
+        '''Add to a counter, also from other threads than the one of the robot'''
+        with self.stat_lock:
+            self.counters[key]+=inc
+
+    def run_later(self,fn,*args):
+        '''Run fn(*args) on the run1 workers of the robot'''
+        def job():
+            current.robot=self
+            try:
+                return fn(*args)
+            finally:
+                current.robot=None
+        self.pending.append(self.run1.submit(job))
+
+    def prefetch(self):
+        '''Read the qualifying tickets at start, to count them and to use them on the first round. Return the count.
+           All of them, also on pushdown: the first round gets more tickets than it would read itself, not less.'''
+        for tries in itertools.count(1):
+            current.robot=self
+            try:
+                subargs=GetSubArgs(self.name,self.cfg)
+                rules=CompiledRules(GetCfgFileName(self.name,self.cfg),subargs,self.cfg)
+                self.prefetched=(rules,ReadQualifyingTickets(self.sco,self.cfg,fields=FieldsToRead(rules)))
+                return len(self.prefetched[1])
+            except ConnectionError as e:                       # Retried like the rounds of RobotLoop
+                RetryConnection(self,tries,e)
+            finally:
+                current.robot=None
+
+    def wait_pending(self):
+        '''Wait for the updates and run1s queued this round to be done, then journal the rules acted on
+           (but those of the failed updates: their tickets are evaluated again next round)'''
+        pending,self.pending=self.pending,[]
+        for fut in pending:
+            fut.result()
+        acted,self.acted=self.acted,[]
+        with self.stat_lock:
+            failed,self.failed=self.failed,set()
+        for tkt,rule,at in acted:
+            if (tkt.get('sys_id'),rule) not in failed:
+                self.journal.record(self.name,tkt,rule,at)
+        if self.cache is not None:
+            for sys_id,_ in failed:
+                self.cache.forget(sys_id)
+
+    def fail(self,sys_id,rule):
+        '''An update of the ticket for the rule failed (on an update worker)'''
+        with self.stat_lock:
+            self.failed.add((sys_id,rule))
+
+def Robots(scli):
+    '''Contexts for all robots of appname'''
+    updates=UpdatePipeline(scli,whole_cfg['global'])
+    journal=None
+    if whole_cfg['global'].get('journal_file'):
+        journal=ActionJournal(whole_cfg['global']['journal_file'],whole_cfg['global'].get('journal_ttl_h',168))
+        atexit.register(journal.save)
+    cluster=None
+    if whole_cfg['global'].get('cluster_store'):
+        cluster=Cluster(LockStoreFor(whole_cfg['global']['cluster_store']),
+            whole_cfg['global'].get('cluster_member') or "{}-{}".format(platform.node(),os.getpid()),whole_cfg['global'].get('cluster_lease_sec',30))
+        cluster.start()
+    return [RobotContext(name,scli,updates,journal,cluster) for name in appname]
+
+def OwnTickets(rbt,tkts):
+    '''The tickets of this member of the cluster'''
+    for tkt in tkts:
+        if rbt.cluster.mine(tkt.get('sys_id')):
+            yield tkt
+        else:
+            rbt.counters['foreign']+=1                         # Another member works on it
+
+def RunRobotOnce(rbt,sys_ids=None):
+    '''Process open tickets once for a single robot. With sys_ids, only those tickets (if still qualifying).'''
+    current.robot=rbt
+    started=time.monotonic()
+    before=Counter(rbt.counters)
+    rbt.timing=Counter()                                       # Seconds of this round: fetch, match, act
+    try:
+        reloaded=[]                                            # Files changed since the previous round
+        rbt.refresh(reloaded)
+        cfg=rbt.cfg
+        subargs=GetSubArgs(rbt.name,cfg,reloaded)             # Rules first, they tell which fields to read
+        rules=CompiledRules(GetCfgFileName(rbt.name,cfg),subargs,cfg,reloaded)
+        if reloaded and rbt.counters['loops']:
+            prtmsg("Reloaded {} in {:.0f} ms".format(", ".join(reloaded),(time.monotonic()-started)*1000),"188")
+        dbgmsg("{} rules: {}".format(rbt.name,[rle.rule for rle in rules]),"281")
+        if rbt.cluster is not None and rbt.cluster_gen!=rbt.cluster.generation:
+            rbt.cluster_gen=rbt.cluster.generation
+            if rbt.cache is not None:                          # Tickets moved between members, read all again
+                rbt.cache.rules=None
+        pre=None
+        if not sys_ids:
+            pre,rbt.prefetched=rbt.prefetched,None
+            if pre is not None and pre[0] is not rules:        # Rules changed since, may need other fields
+                pre=None
+        if sys_ids:
+            tkts=IterQualifyingTickets(rbt.sco,cfg,sys_ids=sys_ids,fields=FieldsToRead(rules),branches=Pushdown(rules,cfg))
+        elif rbt.cache is not None:
+            tkts=ReadChangedTickets(rbt.sco,cfg,rbt.cache,rules,pre[1] if pre is not None else None)
+        elif pre is not None:                                  # Read at start already
+            tkts=pre[1]
+        else:
+            tkts=IterQualifyingTickets(rbt.sco,cfg,fields=FieldsToRead(rules),branches=Pushdown(rules,cfg))
+        if snapshot is not None:
+            tkts=snapshot.tap(rbt,tkts)
+        if rbt.cluster is not None:
+            tkts=OwnTickets(rbt,tkts)
+        tkts=iter(tkts)
+        batch=None
+        if cfg.get('batch_eval',False) and not debug:          # All tickets first, then each rule over all of them
+            clk=time.perf_counter()
+            tkts=list(tkts)
+            rbt.timing['fetch']+=time.perf_counter()-clk
+            clk=time.perf_counter()
+            batch=TicketBatch(rules,tkts,cfg,rbt.rule_stats)
+            rbt.timing['match']+=time.perf_counter()-clk
+            tkts=iter(tkts)
+        for ix in itertools.count():                           # Processed as the pages arrive, unless batch_eval
+            clk=time.perf_counter()
+            tkt=next(tkts,None)
+            rbt.timing['fetch']+=time.perf_counter()-clk
+            if tkt is None:
+                break
+            num=tkt["number"]
+            rbt.counters['tickets']+=1
+            try:
+                tv=batch.views[ix] if batch is not None else TicketView(tkt,bool(cfg.get('ignore_case',False)))
+                clk=time.perf_counter()
+                act0=rbt.timing['act_sync']
+                matched=ProcessSingleTicket(num,tkt,rules,subargs,cfg,rbt.sco,tv,batch.hits(ix) if batch is not None else None)
+                spent=time.perf_counter()-clk
+                rbt.timing['match']+=spent                    # Actions taken off below
+                rbt.hist['match'].observe(spent-(rbt.timing['act_sync']-act0))
+                if matched:
+                    rbt.counters['matched']+=1
+                if rbt.cache is not None:
+                    rbt.cache.store(tkt,tv.recheck)
             except Exception as e:
-                prtmsg("Failed, {} tries to continue, DG: {}".format(robotname,str(e)),"191","E")
-        mpfx=mpfx0
+                rbt.counters['errors']+=1
+                if rbt.cache is not None:
+                    rbt.cache.forget(tkt.get('sys_id'))
+                prtmsg("#{} - unsuccessful, {} trying to continue, DG: {}".format(num,rbt.name,str(e)),"192","E")
+    except ConnectionError:                                    # Retried by the caller
+        raise
+    except Exception as e:
+        rbt.counters['errors']+=1
+        prtmsg("Failed, {} tries to continue, DG: {}".format(rbt.name,str(e)),"191","E")
+    finally:
+        clk=time.perf_counter()
+        rbt.wait_pending()
+        rbt.timing['act']+=time.perf_counter()-clk
+        rbt.counters['event_rounds' if sys_ids else 'loops']+=1
+        round_robin.save()
+        if snapshot is not None:
+            snapshot.flush()
+        if rbt.journal is not None:
+            rbt.journal.save()
+        if rbt.cfg.get('round_stats',False):
+            done=rbt.counters-before
+            prtmsg("Round done in {:.3f} s: tickets={} matched={} fetch={:.3f} match={:.3f} act={:.3f}".format(time.monotonic()-started,
+                done['tickets'],done['matched'],rbt.timing['fetch'],rbt.timing['match']-rbt.timing['act_sync'],rbt.timing['act']+rbt.timing['act_sync']),"189")
+        current.robot=None
+        FlushLog()
 
-def TicketSupervisor(scli):
-    '''Main routine for the supervisor. Build a cfg, enter target + credentials and start running'''
-    prtmsg("Initialized by {} at {}, v{}, {} awake, starting to work at SNC {}. To stop, Ctrl-C or close the window.".format(GetUserName(),platform.node(),VERSION,appname,snc),"008")
+def LoopRobotsOnce(robots):
+    '''Process open tickets once for all robots, side by side.'''
+    with ThreadPoolExecutor(max_workers=len(robots) or 1) as pool:
+        for fut in [pool.submit(RunRobotOnce,rbt) for rbt in robots]:
+            fut.result()                                       # Raise ConnectionError etc. of any robot
+
+class PollSchedule(object):
+    '''Cadence of the rounds of a robot: a round starts every interval seconds, the time a round took is not
+       waited again. After a round with matching (or, on incremental, changed) tickets the interval drops to
+       sleep_min_sec; quiet rounds stretch it by sleep_stretch up to sleep_max_sec. Both bounds default to
+       sleep_sec_between, i.e. a fixed cadence.'''
+    def __init__(self):
+        self.interval=None
+
+    def wait(self,cfg,took,active):
+        '''Seconds to wait after a round that took this long'''
+        base=float(cfg.get('sleep_sec_between',20))
+        low=float(cfg.get('sleep_min_sec',base))
+        high=max(low,float(cfg.get('sleep_max_sec',base)))
+        if self.interval is None or active:
+            self.interval=low
+        else:
+            self.interval*=float(cfg.get('sleep_stretch',1.5))
+        self.interval=max(low,min(high,self.interval))        # Bounds may have changed on cfg reload
+        return max(0.0,self.interval-took)
+
+    @staticmethod
+    def backoff(cfg,tries):
+        '''Seconds to wait before retry #tries after connection errors: doubled each time, with jitter'''
+        delay=min(float(cfg.get('retry_backoff_max_sec',600)),float(cfg.get('retry_backoff_sec',30))*2**(tries-1))
+        return delay/2+random.uniform(0,delay/2)             # Robots failing together do not retry together
+
+class EventQueue(object):
+    '''Tickets notified to a robot, sys_id -> time.monotonic() to process it. A burst of notifications
+       of a ticket not yet processed is one; the first one sets the time, so the burst does not delay it.'''
+    def __init__(self):
+        self.pending={}
+        self.cond=threading.Condition()
+
+    def put(self,sys_id,delay):
+        '''Queue a ticket to be processed in delay seconds, return False if already queued'''
+        with self.cond:
+            if sys_id in self.pending:
+                return False
+            self.pending[sys_id]=time.monotonic()+delay
+            self.cond.notify()
+            return True
+
+    def take(self,until):
+        '''Wait for tickets to process, at most until time.monotonic() is until. Return their sys_ids, [] at until.'''
+        with self.cond:
+            while True:
+                now=time.monotonic()
+                due=[sys_id for sys_id,at in self.pending.items() if at<=now]
+                if due:
+                    for sys_id in due:
+                        del self.pending[sys_id]
+                    return due
+                if now>=until:
+                    return []
+                self.cond.wait(min(min(self.pending.values(),default=until),until)-now)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    '''POST /[robot] of ticket notifications, e.g. from an outbound REST message of a business rule:
+       {"sys_id": "...", "table": "incident", "number": "INC..."} or a list of them. Without robot on the path,
+       the robots working on the table get it (all robots, if no table either).'''
+    def log_message(self,*args):
+        pass
+
+    def reply(self,code,dta):
+        body=json.dumps(dta).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body=self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        token=self.server.cfg.get('webhook_token','')
+        if token and not hmac.compare_digest(self.headers.get('X-Webhook-Token',''),token):
+            self.reply(401,{"error": "Invalid token"})
+            return
+        try:
+            events=json.loads(body or b"[]")
+            if isinstance(events,dict):
+                events=[events]
+            robot=self.path.strip("/").split("?")[0]
+            delay=float(self.server.cfg.get('webhook_debounce_ms',300))/1000
+            queued=0
+            for evt in events:
+                sys_id="{}".format(evt.get('sys_id') or "")
+                if not sys_id:
+                    continue
+                for rbt in self.server.robots:
+                    if robot and robot!=rbt.name:
+                        continue
+                    if not robot and evt.get('table') and evt.get('table')!=rbt.cfg.get('snc_table','incident'):
+                        continue
+                    rbt.count('events')
+                    if rbt.events.put(sys_id,delay):
+                        queued+=1
+                    else:
+                        rbt.count('events_deduped')
+            dbgmsg("Notified: {} tickets, {} queued".format(len(events),queued),"016")
+            self.reply(202,{"queued": queued})
+        except (ValueError,AttributeError) as e:
+            prtmsg("Invalid notification: {} - {}".format(e,body[0:200]),"015","W")
+            self.reply(400,{"error": str(e)})
+
+def StartWebhook(robots,cfg):
+    '''Listen to ticket notifications on http://[webhook_host]:[webhook_port]/, if webhook_port is set'''
+    port=int(cfg.get('webhook_port',0) or 0)
+    if not port:
+        return None
+    srv=ThreadingHTTPServer((cfg.get('webhook_host','127.0.0.1'),port),WebhookHandler)
+    srv.daemon_threads=True
+    srv.robots=[rbt for rbt in robots if rbt.events is not None]
+    srv.cfg=cfg
+    threading.Thread(target=srv.serve_forever,name="webhook",daemon=True).start()
+    prtmsg("Listening to ticket notifications on http://{}:{}/".format(*srv.server_address[0:2]),"014")
+    return srv
+
+def RetryConnection(rbt,tries,e):
+    '''After connection error e, #tries in a row of the robot: wait for the retry, or give up raising e (max_retry_connect)'''
+    maxRetryCount=rbt.cfg.get('max_retry_connect',15)
+    current.robot=rbt
+    try:
+        if tries>maxRetryCount:
+            prtmsg("Terminating due continuing connection trouble","092","E")
+            raise e
+        wait=PollSchedule.backoff(rbt.cfg,tries)
+        prtmsg("Retrying (#{}/{}) a challenging connection in {:.0f} sec - {}".format(tries,maxRetryCount,wait,type(e)),"092","W")
+    finally:
+        current.robot=None
+    time.sleep(wait)
+
+def RobotLoop(rbt):
+    '''Keep on processing tickets of a robot with its own cadence and connection retries, in its own thread'''
     errRetryCount=0
-    for robotname in appname:                                       ### Show configuration file(s)
-        cfg=EffectiveCfgForOneRobot(robotname)
-        for rle in ReadCfg(GetCfgFileName(robotname)):
-            dbgmsg("{}/{} cfg: {}".format(me,robotname,rle),"001")
-        sco=SncResource(scli,cfg.get('snc_table','incident'))
-        prtmsg("... right now, {} eligible {} tickets for {}.".format(len(ReadQualifyingTickets(sco,cfg)),cfg.get('snc_table','incident'),robotname),"009")
+    schedule=PollSchedule()
+    if rbt.events is not None:                                 # Polling just to catch the notifications missed
+        reconcile=float(rbt.cfg.get('webhook_reconcile_sec',600))
+    try:
+        while True:
+            started=time.monotonic()
+            before=Counter(rbt.counters)
+            try:
+                RunRobotOnce(rbt)
+                errRetryCount=0
+                took=time.monotonic()-started
+                done=rbt.counters-before
+                scfg=rbt.cfg
+                if rbt.events is not None:
+                    scfg=dict(scfg,sleep_sec_between=reconcile,sleep_min_sec=reconcile,sleep_max_sec=reconcile)
+                wait=schedule.wait(scfg,took,done['matched']>0 or (rbt.cache is not None and done['tickets']>0))
+                if took>schedule.interval:
+                    rbt.counters['overruns']+=1                # Round longer than the interval
+                if debug:
+                    current.robot=rbt
+                    dbgmsg("Round took {:.1f} sec, next in {:.1f} sec (interval {:.1f})".format(took,wait,schedule.interval),"093")
+                    current.robot=None
+                rbt.idle(wait)                                 # Event rounds retried like the polling ones
+            except ConnectionError as e:
+                errRetryCount+=1
+                RetryConnection(rbt,errRetryCount,e)
+    except Exception as e:
+        rbt.error=e
 
-    while True:
+def PromLabel(val):
+    return '{}'.format(val).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def Metrics(robots):
+    '''Counters, histograms and rule statistics of the robots in Prometheus text format'''
+    lines=[]
+    counters=[('rounds','loops'),('tickets','tickets'),('matched','matched'),('errors','errors'),('overruns','overruns'),
+        ('event_rounds','event_rounds'),('events','events'),('events_deduped','events_deduped'),('journaled','journaled'),
+        ('foreign','foreign'),('claim_lost','claim_lost')]
+    for name,key in counters:
+        lines.append("# TYPE ticketsupervisor_{}_total counter".format(name))
+        lines+=['ticketsupervisor_{}_total{{robot="{}"}} {}'.format(name,PromLabel(rbt.name),rbt.counters[key]) for rbt in robots]
+    for name in ('api_calls','api_errors'):
+        lines.append("# TYPE ticketsupervisor_{}_total counter".format(name))
+        for rbt in robots:
+            for call in ('get','patch','update'):
+                key="api_{}{}".format(call,"_errors" if name=="api_errors" else "")
+                lines.append('ticketsupervisor_{}_total{{robot="{}",call="{}"}} {}'.format(name,PromLabel(rbt.name),call,rbt.counters[key]))
+    for key in ('fetch','match','act'):
+        lines.append("# TYPE ticketsupervisor_{}_seconds histogram".format(key))
+        for rbt in robots:
+            lines+=rbt.hist[key].prometheus("ticketsupervisor_{}_seconds".format(key),'robot="{}"'.format(PromLabel(rbt.name)))
+    for ix,name in enumerate(('rule_evaluations_total','rule_matches_total','rule_cpu_seconds_total')):
+        lines.append("# TYPE ticketsupervisor_{} counter".format(name))
+        for rbt in robots:
+            for rule,stat in list(rbt.rule_stats.items()):
+                lines.append('ticketsupervisor_{}{{robot="{}",rule="{}"}} {}'.format(name,PromLabel(rbt.name),PromLabel(rule),stat[ix]))
+    return "\n".join(lines)+"\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''GET /metrics of the robots of the server'''
+    def log_message(self,*args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0]!="/metrics":
+            self.send_error(404)
+            return
+        body=Metrics(self.server.robots).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def StartMetrics(robots,cfg):
+    '''Serve the metrics on http://[metrics_host]:[metrics_port]/metrics, if metrics_port is set'''
+    port=int(cfg.get('metrics_port',0) or 0)
+    if not port:
+        return None
+    srv=ThreadingHTTPServer((cfg.get('metrics_host','127.0.0.1'),port),MetricsHandler)
+    srv.daemon_threads=True
+    srv.robots=robots
+    threading.Thread(target=srv.serve_forever,name="metrics",daemon=True).start()
+    prtmsg("Metrics on http://{}:{}/metrics".format(*srv.server_address[0:2]),"010")
+    return srv
+
+def StatsDump(robots):
+    '''Log the statistics of each robot, with the rules taking most CPU'''
+    for rbt in robots:
+        current.robot=rbt
+        cnt=rbt.counters
+        prtmsg("Stats: {} rounds, {} tickets, {} matched, {} errors, {} overruns; p50/p95 s fetch {}/{}, match {}/{}, act {}/{}; API get {} ({} errors), patch {} ({} errors)".format(
+            cnt['loops'],cnt['tickets'],cnt['matched'],cnt['errors'],cnt['overruns'],
+            rbt.hist['fetch'].quantile(0.5),rbt.hist['fetch'].quantile(0.95),rbt.hist['match'].quantile(0.5),rbt.hist['match'].quantile(0.95),
+            rbt.hist['act'].quantile(0.5),rbt.hist['act'].quantile(0.95),
+            cnt['api_get'],cnt['api_get_errors'],cnt['api_patch'],cnt['api_patch_errors']),"011")
+        top=sorted(list(rbt.rule_stats.items()),key=lambda item: -item[1][2])[0:5]
+        if top:
+            prtmsg("Rules by CPU: {}".format(", ".join("{} {:.3f} s ({} evaluated, {} matched)".format(rule,stat[2],stat[0],stat[1])
+                for rule,stat in top)),"012")
+        current.robot=None
+
+def ProfileRobotsOnce(robots,filen):
+    '''Process open tickets once, robot by robot in this thread, under cProfile. Write the stats to filen and
+       show the top of them. The time of the updates & run1s on their workers is shown as waiting for them.'''
+    import cProfile, pstats
+    prof=cProfile.Profile()
+    prof.enable()
+    for rbt in robots:
+        RunRobotOnce(rbt)
+    prof.disable()
+    prof.dump_stats(filen)
+    out=io.StringIO()
+    pstats.Stats(prof,stream=out).sort_stats('cumulative').print_stats(30)
+    print(out.getvalue())
+    StatsDump(robots)
+    prtmsg("Profile written to {}, e.g. python -m pstats {}".format(filen,filen),"013")
+
+class SnapshotWriter(object):
+    '''--record: tickets read, as JSON lines {"robot", "table", "at", "tkt"}, each version (sys_updated_on) of a
+       ticket once. A file name ending .gz is compressed, a gzip member per round, so that a killed --record
+       loses just the round going on; a plain file can be split between the workers of --replay by byte ranges,
+       mapped to memory.'''
+    def __init__(self,path):
+        self.path=path
+        self.gz=path.endswith(".gz")
+        if self.gz and os.path.isfile(path):
+            size=os.path.getsize(path)
+            intact=GzipIntact(path)
+            if intact<size:                                    # Appended after a cut member, nothing would be readable
+                with open(path,'r+b') as snap:
+                    snap.truncate(intact)
+                prtmsg("Dropped {} bytes of an unfinished round at the end of {}".format(size-intact,path),"019","W")
+        self.file=None if self.gz else open(path,'a',encoding='utf-8')
+        self.seen={}                                           # (robot, sys_id): sys_updated_on written last
+        self.lock=threading.Lock()
+        self.count=0
+
+    def tap(self,rbt,tkts):
+        '''Pass the tickets on, writing the new versions of them'''
+        table=rbt.cfg.get('snc_table','incident')
+        for tkt in tkts:
+            key=(rbt.name,tkt.get('sys_id'))
+            if self.seen.get(key)!=tkt.get('sys_updated_on'):
+                line=json.dumps({'robot': rbt.name,'table': table,'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),'tkt': tkt},sort_keys=True)
+                with self.lock:
+                    self.seen[key]=tkt.get('sys_updated_on')
+                    if self.file is None:
+                        self.file=gzip.open(self.path,'at',encoding='utf-8')
+                    self.file.write(line+"\n")
+                    self.count+=1
+            yield tkt
+
+    def flush(self):
+        '''End of a round: to disk, a gzip member finished'''
+        with self.lock:
+            if self.file is None:
+                return
+            if self.gz:
+                self.file.close()
+                self.file=None
+            else:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file=None
+        prtmsg("Recorded {} ticket versions to {}".format(self.count,self.path),"019")
+
+def GzipIntact(path):
+    '''Bytes of a gzip file up to the end of its last complete member'''
+    intact=pos=0
+    dec=zlib.decompressobj(wbits=31)
+    with open(path,'rb') as snap:
+        try:
+            for data in iter(lambda: snap.read(1<<20),b""):
+                while data:
+                    dec.decompress(data,1<<20)                 # Output not needed, bounded
+                    while dec.unconsumed_tail and not dec.eof:
+                        dec.decompress(dec.unconsumed_tail,1<<20)
+                    if not dec.eof:
+                        pos+=len(data)
+                        break
+                    pos+=len(data)-len(dec.unused_data)
+                    intact=pos
+                    data=dec.unused_data
+                    dec=zlib.decompressobj(wbits=31)
+        except zlib.error:
+            pass
+    return intact
+
+def SnapshotChunks(path,size=4000):
+    '''Work for the --replay workers: byte ranges of a plain file, lists of lines of a .gz one'''
+    if path.endswith(".gz"):
+        lines=[]
+        with gzip.open(path,'rt',encoding='utf-8') as snap:
+            try:
+                for line in snap:
+                    lines.append(line)
+                    if len(lines)>=size:
+                        yield lines
+                        lines=[]
+            except EOFError:                                   # Cut short by a killed --record, replay what is there
+                prtmsg("{} ends in an unfinished round, replaying the part before it".format(path),"020","W")
+                if lines and not lines[-1].endswith("\n"):
+                    lines.pop()
+        if lines:
+            yield lines
+    else:
+        total=os.path.getsize(path)
+        with open(path,'rb') as snap:
+            start=0
+            while start<total:
+                snap.seek(min(start+size*1000,total))          # About size tickets of 1 kB, to the end of a line
+                snap.readline()
+                end=min(snap.tell(),total)
+                yield (path,start,end)
+                start=end
+
+def ReplayInit(whole,dbg):
+    '''Worker of --replay: take the cfg of the parent (also on windows, where the workers start afresh)'''
+    global whole_cfg,debug,quiet
+    whole_cfg=whole
+    debug=dbg
+    quiet=True
+
+def ReplayLines(chunk):
+    '''Lines of a chunk of SnapshotChunks'''
+    if isinstance(chunk,list):
+        return chunk
+    path,start,end=chunk
+    with open(path,'rb') as snap:
+        with mmap.mmap(snap.fileno(),0,access=mmap.ACCESS_READ) as mem:
+            return mem[start:end].decode('utf-8').splitlines()
+
+@lru_cache(maxsize=None)
+def ReplayRules(robotname,rulefile):
+    '''Compiled rules of a robot, or of another version of its rule file'''
+    cfg=EffectiveCfgForOneRobot(robotname)
+    subargs=GetSubArgs(robotname,cfg)
+    return cfg,subargs,CompiledRules(rulefile or GetCfgFileName(robotname,cfg),subargs,cfg)
+
+def ReplayMatches(num,tkt,cfg,subargs,rules):
+    '''Names of the rules that would act on the ticket, as ProcessSingleTicket'''
+    tv=TicketView(tkt,bool(cfg.get('ignore_case',False)))
+    runargs=ChainMap(subargs,tkt)
+    rules.scan(tv)
+    names=[]
+    for ix,rle in enumerate(rules):
+        if rules.candidate(ix,tv) and TicketMatchesRule(num,tv,rle,runargs):
+            names.append(rle.name)
+            if cfg.get('first_match_only',False):
+                break
+    return names
+
+def ReplayChunk(chunk,robots,against):
+    '''Evaluate the rules (and the rules of against, robot -> earlier rule file) on the tickets of a chunk in a worker.
+       Return [(robot, number, sys_id, at, rules acting, rules of against acting)]'''
+    global replay_at
+    results=[]
+    for line in ReplayLines(chunk):
         try:
-            LoopRobotsOnce(scli)
-            errRetryCount=0
-        except ConnectionError as e:
-            errRetryCount+=1
-            maxRetryCount=whole_cfg['global'].get('max_retry_connect',15)
-            if errRetryCount <= maxRetryCount:
-                prtmsg("Retrying (#{}/{}) a challenging connection in a while - {}".format(errRetryCount,maxRetryCount,type(e)),"092","W")
-                time.sleep(30)
+            rec=json.loads(line)
+        except ValueError:
+            prtmsg("Not a recorded ticket: {}".format(line[0:80]),"024","W")
+            continue
+        robotname=rec.get('robot')
+        if robotname not in robots:
+            continue
+        tkt=rec['tkt']
+        num=tkt.get('number')
+        replay_at=datetime.strptime(rec['at'],"%Y-%m-%d %H:%M:%S")
+        new=ReplayMatches(num,tkt,*ReplayRules(robotname,None))
+        old=ReplayMatches(num,tkt,*ReplayRules(robotname,against[robotname])) if robotname in against else None
+        results.append((robotname,num,tkt.get('sys_id'),rec['at'],new,old))
+    return results
+
+def ShowSome(nums,count=20):
+    '''Some ticket numbers of many'''
+    nums=sorted(set(nums))
+    return ", ".join(nums[0:count])+(" ... (+{})".format(len(nums)-count) if len(nums)>count else "")
+
+def AgainstFiles(args,robots):
+    '''--against: robot -> earlier rule file; given as robot=file, or as a bare file name if there is a single robot'''
+    against={}
+    for arg in args:
+        robotname,sep,rulefile=arg.partition("=")
+        if not sep:
+            if len(robots)!=1:
+                raise ValueError("--against {}: which robot of {}? Give it as robot={}".format(arg,",".join(robots),arg))
+            robotname,rulefile=robots[0],arg
+        if robotname not in robots:
+            raise ValueError("--against {}: no robot {} in {}".format(arg,robotname,",".join(robots)))
+        against[robotname]=rulefile
+    return against
+
+def ReplaySnapshot(path,robots,against=None,out=""):
+    '''--replay: evaluate the rules of the robots on the tickets of a --record snapshot, on a pool of processes.
+       Show per rule the tickets it would act on; with against (robot -> earlier rule file), how that changes.'''
+    started=time.monotonic()
+    against=against or {}
+    acting={}                                                  # robot -> rule -> [numbers]
+    before={}                                                  # ... with the rules of against
+    changed=[]
+    total=0
+    outf=open(out,'w',encoding='utf-8') if out else None
+    try:
+        with ProcessPoolExecutor(initializer=ReplayInit,initargs=(whole_cfg,debug)) as pool:
+            for results in pool.map(ReplayChunk,SnapshotChunks(path),itertools.repeat(robots),itertools.repeat(against)):
+                for robotname,num,sys_id,at,new,old in results:
+                    total+=1
+                    for name in new:
+                        acting.setdefault(robotname,{}).setdefault(name,[]).append(num)
+                    if old is not None:
+                        for name in old:
+                            before.setdefault(robotname,{}).setdefault(name,[]).append(num)
+                        if old!=new:
+                            changed.append((robotname,num,old,new))
+                    if outf:
+                        outf.write(json.dumps({'robot': robotname,'number': num,'sys_id': sys_id,'at': at,'rules': new,'against': old})+"\n")
+    finally:
+        if outf:
+            outf.close()
+    prtmsg("Replayed {} recorded tickets of {} in {:.2f} s".format(total,path,time.monotonic()-started),"020")
+    for robotname in robots:
+        now=acting.get(robotname,{})
+        was=before.get(robotname,{})
+        names=[rle.name for rle in ReplayRules(robotname,None)[2]]   # In the order of the rule file
+        for name in names+[name for name in was if name not in names]:
+            nums=now.get(name,[])
+            if robotname in against:
+                prtmsg("{} {}: {} -> {} tickets: {}".format(robotname,name,len(was.get(name,[])),len(nums),ShowSome(nums)),"021")
             else:
-                prtmsg("Terminating due continuing connection trouble","092","E")
-                raise e
-        time.sleep(whole_cfg['global'].get('sleep_sec_between',20))
+                prtmsg("{} {}: {} tickets: {}".format(robotname,name,len(nums),ShowSome(nums)),"021")
+    for robotname,num,old,new in changed[0:100]:
+        prtmsg("{} #{} {} -> {}".format(robotname,num,",".join(old) or "NA",",".join(new) or "NA"),"022")
+    for robotname,rulefile in against.items():
+        prtmsg("{} tickets acted on differently by {} than with {}".format(sum(1 for chg in changed if chg[0]==robotname),robotname,rulefile),"023")
+
+def TicketSupervisor(scli):
+    '''Main routine for the supervisor. Build a cfg, enter target + credentials and start running'''
+    prtmsg("Initialized by {} at {}, v{}, {} awake, starting to work at SNC {}. To stop, Ctrl-C or close the window.".format(GetUserName(),platform.node(),VERSION,appname,snc),"008")
+    robots=Robots(scli)
+    for rbt in robots:                                         ### Show configuration file(s)
+        for rle in cfg_files.load(GetCfgFileName(rbt.name,rbt.cfg)) or []:
+            dbgmsg("{}/{} cfg: {}".format(me,rbt.name,rle),"001")
+    with ThreadPoolExecutor(max_workers=len(robots) or 1) as pool:   # Tickets of the 1st rounds, all robots at once
+        counts=list(pool.map(RobotContext.prefetch,robots))
+    for rbt,count in zip(robots,counts):
+        prtmsg("... right now, {} eligible {} tickets for {}.".format(count,rbt.cfg.get('snc_table','incident'),rbt.name),"009")
+
+    StartMetrics(robots,whole_cfg['global'])
+    StartWebhook(robots,whole_cfg['global'])
+    dump_sec=float(whole_cfg['global'].get('stats_dump_sec',0) or 0)
+    dumped=time.monotonic()
+    threads=[threading.Thread(target=RobotLoop,args=(rbt,),name=rbt.name,daemon=True) for rbt in robots]
+    for thr in threads:                                        # Each robot on its own, the slowest one delays no one
+        thr.start()
+    while all(thr.is_alive() for thr in threads):
+        time.sleep(1)
+        if dump_sec and time.monotonic()-dumped>=dump_sec:
+            StatsDump(robots)
+            dumped=time.monotonic()
+        FlushLog(due_only=True)                                # Lines of robots sleeping between rounds
+    for rbt in robots:                                         # A robot gave up, so do I
+        if rbt.error is not None:
+            raise rbt.error
 ############################################################################################
 if __name__ == '__main__':
+    multiprocessing.freeze_support()                                        # --replay pool on windows exe
     try:
         me=os.path.basename(sys.argv[0])
         if "--version" in sys.argv:
             prtmsg("Version: {} - {}".format(VERSION,me))
             sys.exit()
-        cfgfn="TicketSupervisor.cfg"
         if os.path.isfile(cfgfn):                                            ### Fetch .cfg
-            whole_cfg=yaml.load(open(cfgfn,'r'),Loader=yaml.Loader)
+            whole_cfg=cfg_files.load(cfgfn)
         log_dir=whole_cfg['global'].get('log_dir','')
+        logw.configure(whole_cfg['global'])
         parser=argparse.ArgumentParser(description='Personal Assistant for ServiceNow Tickets. Performs actions against arrived matching tickets. Configuration on [appname].txt, run args on TiecketSupervisor.cfg')
         snc=whole_cfg['global'].get('snc','')
-        parser.add_argument("-s", "--servicenow", help="The name of the ServiceNow system", action="store", default=snc, type=str, required=bool(not snc))
+        parser.add_argument("-s", "--servicenow", help="The name of the ServiceNow system", action="store", default=snc, type=str, required=bool(not snc) and "--replay" not in sys.argv)
         user=whole_cfg['global'].get('user','')
-        parser.add_argument("-u", "--username", help="Username to connect ServiceNow system", action="store", default=user, type=str, required=bool(not user))
+        parser.add_argument("-u", "--username", help="Username to connect ServiceNow system", action="store", default=user, type=str, required=bool(not user) and "--replay" not in sys.argv)
         pwd=whole_cfg['global'].get('pwd','')
-        parser.add_argument("-p", "--password", help="Password related to username", action="store", default=pwd, type=str, required=bool(not pwd))
+        parser.add_argument("-p", "--password", help="Password related to username", action="store", default=pwd, type=str, required=bool(not pwd) and "--replay" not in sys.argv)
         parser.add_argument("--debug", help="Generate additional diagnostic messages", action="store_true", dest="debug")
         parser.add_argument("--simulate", help="Read-only, perform no changes to tickets", action="store_true", dest="simulate")
         parser.add_argument("--once", help="Run just once, not on continuous loop", action="store_true", dest="once")
         parser.add_argument("--quiet", help="Be less verbose", action="store_true", dest="quiet")
         parser.add_argument("--appname", help="Name of virtual assistant", action="store", dest="appname", default=whole_cfg['global'].get('appname',appname), type=str)
+        parser.add_argument("--profile", help="Run once under cProfile, write the stats to this file", action="store", dest="profile", default="", type=str)
+        parser.add_argument("--record", help="Save the tickets read to this file (.gz compressed) for --replay", action="store", dest="record", default="", type=str)
+        parser.add_argument("--replay", help="Evaluate the rules on the tickets of a --record file instead of SNC, no changes", action="store", dest="replay", default="", type=str)
+        parser.add_argument("--against", help="On --replay, compare to this earlier version of the rule file of a robot: [robot=]file, once per robot", action="append", dest="against", default=[], type=str)
+        parser.add_argument("--replay_out", help="On --replay, write the rules acting on each ticket to this JSON lines file", action="store", dest="replay_out", default="", type=str)
         parser.add_argument("--show1", help="Show all attributes of the ticket, value=INCnnnnnnn", action="store", dest="show1", default="", type=str)
         runa=parser.parse_args(sys.argv[1:])
         debug=runa.debug
         quiet=runa.quiet
         simulation=runa.simulate
+        rule_cpu=bool(runa.profile or whole_cfg['global'].get('metrics_port',0) or whole_cfg['global'].get('stats_dump_sec',0))
         appname=runa.appname
         if type(appname) is str:
             appname=[appname]
@@ -449,14 +2456,28 @@ if __name__ == '__main__':
         user=runa.username
         pwd=runa.password
         cfg=EffectiveCfgForOneRobot(appname[0])
-        cfgfile=GetCfgFileName(appname[0])
+        if runa.replay:                      ##################################################### Rules against recorded tickets, no SNC
+            try:
+                against=AgainstFiles(runa.against,appname)
+            except ValueError as e:
+                parser.error(str(e))
+            ReplaySnapshot(runa.replay,appname,against,runa.replay_out)
+            sys.exit()
+        if runa.record:
+            snapshot=SnapshotWriter(runa.record)
+            atexit.register(snapshot.close)
         scli=SncConnection(snc,user,pwd)
         if runa.show1:                       ##################################################### Show contents of a ticket (e.g. to see field names and values)
             sco=SncResource(scli,'incident')
             for tkt in sco.get(query=(pysnow.QueryBuilder().field('number').equals(runa.show1))).all():
                 print(json.dumps(tkt,indent=4,sort_keys=True))
+        elif runa.profile:                   ##################################################### Run single time under cProfile
+            ProfileRobotsOnce(Robots(scli),runa.profile)
         elif runa.once:                      ##################################################### Run single time
-            LoopRobotsOnce(scli)
+            robots=Robots(scli)
+            LoopRobotsOnce(robots)
+            if whole_cfg['global'].get('stats_dump_sec',0):
+                StatsDump(robots)
         else:                                ##################################################### Run as daemon, looping every n+1 seconds
             TicketSupervisor(scli)
     except Exception as e: